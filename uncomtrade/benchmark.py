@@ -0,0 +1,173 @@
+"""
+End-to-end throughput benchmark of the fetchers against the local mock
+server (mock_server.py), so that changes to the request engine, planner,
+caches or writers can be compared without network access or quota.
+
+Each scenario starts from an empty cache directory and working directory
+and reports wall time, requests that spent quota (data, availability and
+bulk) and per hour, rows per second and peak memory.
+
+Usage:
+python benchmark.py --latency 0.5 --scenarios import taiwan bulk parse --json results.json
+"""
+
+import argparse
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import tracemalloc
+from time import monotonic
+
+import comtrade
+import mock_server
+
+def _reset(directory):
+    """Point comtrade at a fresh cache directory and drop its cached state."""
+    comtrade.cache_dir = os.path.join(directory, 'cache')
+    comtrade.bulk_dest = os.path.join(directory, 'bulk') + os.sep
+    os.makedirs(comtrade.bulk_dest)
+    comtrade._reference.clear()
+    comtrade._availability_store = None
+    comtrade._trade_store = None
+    comtrade._row_estimates = None
+    comtrade._response_cache = None
+
+def _reset_peak_rss():
+    """Reset the peak resident set size of the process (Linux); return whether it was."""
+    try:
+        with open('/proc/self/clear_refs', mode = 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_mb():
+    """Peak resident set size since the last reset, in MB."""
+    with open('/proc/self/status') as file:
+        for line in file:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+
+def _count_rows(filename):
+    with (gzip.open if filename.endswith('.gz') else open)(filename, mode = 'rb') as file:
+        return max(sum(1 for _ in file) - 1, 0)
+
+def scenario_import(mock):
+    """get_import for the first reporter: every partner, 76 months."""
+    comtrade.get_import(mock.reporters[0])
+
+def scenario_taiwan(mock):
+    """get_taiwan for one month: every reporter, partner 490."""
+    comtrade.get_taiwan(2015, 6)
+
+def scenario_bulk(mock):
+    """download_bulk for one year, reduced to bulk_columns."""
+    return _count_rows(comtrade.download_bulk(2016))
+
+def scenario_parse(mock):
+    """parse_records on one large generated response."""
+    content = mock._csv(mock.rows(mock.reporters, mock.partners, ['2016'], ['1', '2'])).encode('utf-8')
+    return len(comtrade.parse_records(content))
+
+scenarios = {'import': scenario_import,
+             'taiwan': scenario_taiwan,
+             'bulk': scenario_bulk,
+             'parse': scenario_parse
+}
+
+def run(names = None, mock = None, trace_memory = False):
+    """
+    Run the named scenarios (all by default) against a mock server started
+    in-process and return one result dict per scenario.
+    """
+    mock = mock or mock_server.MockComtrade()
+    server = mock_server.serve(mock)
+    settings = {x: getattr(comtrade, x) for x in ['base_url', 'cache_dir', 'bulk_dest', 'rate_limiter']}
+    cwd = os.getcwd()
+    comtrade.base_url = server.url
+    # The mock's own limits, if any, are what is being measured; the client
+    # side budget is lifted so it does not hide them.
+    comtrade.rate_limiter = comtrade.RateLimiter(hourly_budget = 10 ** 9, burst = comtrade.concurrency)
+    results = []
+    try:
+        for name in names or scenarios:
+            directory = tempfile.mkdtemp(prefix = 'uncomtrade-benchmark-')
+            try:
+                _reset(directory)
+                os.chdir(directory)
+                before = dict(mock.stats)
+                comtrade.metrics.reset()
+                # ru_maxrss is the peak over the life of the process, so later
+                # scenarios would report the memory of earlier ones.
+                rss = _reset_peak_rss()
+                if trace_memory:
+                    tracemalloc.start()
+                started = monotonic()
+                rows = scenarios[name](mock)
+                elapsed = monotonic() - started
+                peak_rss = _peak_rss_mb() if rss else None
+                peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+                if trace_memory:
+                    tracemalloc.stop()
+            finally:
+                os.chdir(cwd)
+                shutil.rmtree(directory, ignore_errors = True)
+            sent = {k: mock.stats[k] - before.get(k, 0) for k in mock.stats}
+            if rows is None:
+                rows = sent.get('rows', 0)
+            metrics = comtrade.metrics.summary()
+            # Every request that spent quota, not only the /api/get ones.
+            requests = metrics['counters'].get('requests', 0)
+            results.append({'scenario': name,
+                            'seconds': elapsed,
+                            'requests': requests,
+                            'requests_per_hour': requests / elapsed * 3600,
+                            'rate_limited': sent.get('rate_limited', 0),
+                            'errors': sent.get('errors', 0),
+                            'rows': rows,
+                            'rows_per_second': rows / elapsed,
+                            'megabytes_received': sent.get('bytes', 0) / 1024 ** 2,
+                            'peak_traced_mb': peak / 1024 ** 2 if peak is not None else None,
+                            'max_rss_mb': peak_rss,
+                            'metrics': metrics
+            })
+    finally:
+        for k, v in settings.items():
+            setattr(comtrade, k, v)
+        server.shutdown()
+    return results
+
+def report(results):
+    print('\n{:<10}{:>10}{:>10}{:>12}{:>10}{:>12}{:>10}'.format(
+        'scenario', 'seconds', 'requests', 'req/hour', 'rows', 'rows/s', 'rss MB'))
+    for x in results:
+        print('{:<10}{:>10.2f}{:>10}{:>12.0f}{:>10}{:>12.0f}{:>10}'.format(
+            x['scenario'], x['seconds'], x['requests'], x['requests_per_hour'], x['rows'],
+            x['rows_per_second'], '?' if x['max_rss_mb'] is None else round(x['max_rss_mb'])))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark the fetchers against the mock Comtrade server.')
+    parser.add_argument('--scenarios', nargs = '+', choices = list(scenarios), default = list(scenarios))
+    parser.add_argument('--reporters', type = int, default = 20)
+    parser.add_argument('--partners', type = int, default = 30)
+    parser.add_argument('--rows-per-cell', type = int, default = 50)
+    parser.add_argument('--empty-ratio', type = float, default = 0.3)
+    parser.add_argument('--latency', type = float, default = 0.0)
+    parser.add_argument('--error-rate', type = float, default = 0.0)
+    parser.add_argument('--rate-limit', type = float, default = None)
+    parser.add_argument('--hourly-quota', type = int, default = None)
+    parser.add_argument('--rate-limit-status', type = int, choices = [409, 429], default = 409)
+    parser.add_argument('--trace-memory', action = 'store_true',
+                        help = 'Also report the peak of Python allocations (slower).')
+    parser.add_argument('--json', help = 'Write the results to this file.')
+    args = parser.parse_args()
+    mock = mock_server.MockComtrade(args.reporters, args.partners, args.rows_per_cell, args.empty_ratio,
+                                    args.latency, args.error_rate, args.rate_limit, args.hourly_quota,
+                                    rate_limit_status = args.rate_limit_status)
+    results = run(args.scenarios, mock, args.trace_memory)
+    report(results)
+    if args.json:
+        with open(args.json, mode = 'w') as file:
+            json.dump(results, file, indent = 2)
@@ -1,194 +1,1929 @@
 import urllib.parse
-import requests
+import re
+import asyncio
+import threading
+import sqlite3
+import itertools
+import collections
+import csv
+import io
+import gzip
+import hashlib
+import socket
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import random
+import importlib
+import importlib.util
 import json
-import pandas as pd
-from time import strftime, sleep
+import argparse
+import sys
+from time import strftime, sleep, time, monotonic
 import datetime
 import calendar
-import os.path
+import email.utils
+import os
+import tempfile
+
+class _LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access, so
+    that importing this one, and starting the command line runner, does
+    not pay for pandas and requests until they are used.
+    """
+    
+    def __init__(self, *names):
+        self._names = names
+        self._module = None
+    
+    def __getattr__(self, name):
+        if self._module is None:
+            for x in self._names:
+                importlib.import_module(x)
+            self._module = sys.modules[self._names[0]]
+        return getattr(self._module, name)
+
+def _optional(*names):
+    """Return a _LazyModule for an optional dependency, None if it is not installed."""
+    return _LazyModule(*names) if importlib.util.find_spec(names[0]) is not None else None
+
+requests = _LazyModule('requests', 'requests.adapters')
+pd = _LazyModule('pandas')
+pyarrow = _optional('pyarrow', 'pyarrow.parquet')
+zstandard = _optional('zstandard')
 
 auth_code = ''
+base_url = 'http://comtrade.un.org'
 
-def check_availability(period, freq = 'A'):
+def get_availability(period, freq = 'A'):
     """
-    Query data availability for the specified year.
-    Return a dict of query results.
+    Query data availability for the specified period.
+    Return the list of availability records, one per reporter.
     
     Period input:
     YYYY for annual data ('A') or YYYYMM for monthly data ('M')
     """
-    url = 'http://comtrade.un.org/api//refs/da/bulk?parameters'
+    url = base_url + '/api//refs/da/bulk?parameters'
     payload = {'r': 'all',
                'freq': freq,
                'ps': str(period),
                'px': 'HS',
-               'type': 'C',
-               'token': auth_code
+               'type': 'C'
     }
-    r = requests.get(url, urllib.parse.urlencode(payload))
-    return r.json()[0]
-
-def download_bulk(year = datetime.datetime.now().year - 1, reduce = True):
-    """Return a csv file."""
-    url = 'http://comtrade.un.org/api/get/bulk/C/A/{}/ALL/HS?token={}'.format(year, auth_code)
-    r = requests.get(url)
-    
-    dest = '//172.20.23.190/ds/Raw Data/UN_Comtrade/complete_year_data/'
-    filename = dest + str(year) + '.csv'
-    if reduce = False:
-        with open(filename, encoding = 'utf-8', mode = 'w', newline = '') as file:
-            file.write(r.text)
-    else:
-        df = pd.read_csv(r.text, usecols = ['Trade Flow Code',
-                                            'Reporter Code',
-                                            'Partner Code',
-                                            'Commodity Code',
-                                            'Qty Unit Code',
-                                            'Qty',
-                                            'Netweight (kg)',
-                                            'Trade Value (US$)']
-        )
-        df.to_csv(filename, index = False, encoding = 'utf-8')
-    size = os.path.getsize(filename) / 1024 ** 2
-    print('Successfully downloaded data for {} ({} GB).'.format(str(year), str(size)))
-    return
+    token = _acquire('availability')
+    if token:
+        payload['token'] = token
+    r = session().get(url, params = urllib.parse.urlencode(payload), timeout = timeout)
+    return r.json()
+
+def check_availability(period, freq = 'A'):
+    """
+    Query data availability for the specified year.
+    Return a dict of query results.
+    
+    Period input:
+    YYYY for annual data ('A') or YYYYMM for monthly data ('M')
+    """
+    return get_availability(period, freq)[0]
+
+class AvailabilityStore:
+    """
+    Availability records (reporter, period, publication date, number of
+    records) kept in an SQLite file, together with the publication date
+    each reporter-period had when it was last fetched. Reporter-periods
+    whose publication date differs from the synced one are new or revised.
+    """
+    
+    def __init__(self, filename = None):
+        if filename is None:
+            filename = os.path.join(cache_dir, 'availability.sqlite')
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok = True)
+        self.db = sqlite3.connect(filename, check_same_thread = False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS records (r TEXT, ps TEXT, freq TEXT, px TEXT, '
+                            'published TEXT, total INTEGER, synced TEXT, PRIMARY KEY (r, ps, freq, px))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS checked (ps TEXT, freq TEXT, px TEXT, at REAL, '
+                            'PRIMARY KEY (ps, freq, px))')
+    
+    def checked(self, period, freq, px = 'HS'):
+        """Return when availability for period was last fetched, or None."""
+        with self.lock:
+            row = self.db.execute('SELECT at FROM checked WHERE ps = ? AND freq = ? AND px = ?',
+                                  (str(period), freq, px)).fetchone()
+            return row[0] if row else None
+    
+    def update(self, records, period = None, freq = None, px = 'HS'):
+        """
+        Store availability records as returned by get_availability. Given
+        the period and freq they answer, the period is marked as checked,
+        even if no reporter has data for it, and the records are stored
+        under that freq and px whatever the server labels them with.
+        """
+        if period is not None:
+            with self.lock, self.db:
+                self.db.execute('INSERT OR REPLACE INTO checked VALUES (?, ?, ?, ?)', (str(period), freq, px, time()))
+        with self.lock, self.db:
+            self.db.executemany('INSERT INTO records (r, ps, freq, px, published, total) VALUES (?, ?, ?, ?, ?, ?) '
+                                'ON CONFLICT (r, ps, freq, px) DO UPDATE SET published = excluded.published, '
+                                'total = excluded.total',
+                                [(str(x['r']), str(x['ps']), freq or x['freq'], px, x.get('publicationDate'),
+                                  x.get('TotalRecords')) for x in records])
+    
+    def changed(self, periods, freq, px = 'HS'):
+        """Return the (reporter, period) pairs not synced since their last publication."""
+        periods = [str(x) for x in periods]
+        with self.lock:
+            cursor = self.db.execute('SELECT r, ps FROM records WHERE freq = ? AND px = ? AND ps IN ({}) '
+                                     'AND synced IS NOT published ORDER BY r, ps'.format(','.join('?' * len(periods))),
+                                     [freq, px] + periods)
+            return cursor.fetchall()
+    
+    def available(self, periods, freq, px = 'HS'):
+        """Return {(reporter, period): number of records} for the given periods."""
+        periods = [str(x) for x in periods]
+        with self.lock:
+            cursor = self.db.execute('SELECT r, ps, total FROM records WHERE freq = ? AND px = ? AND ps IN ({})'.format(
+                ','.join('?' * len(periods))), [freq, px] + periods)
+            return {(r, ps): total for r, ps, total in cursor}
+    
+    def mark_synced(self, reporter, period, freq, px = 'HS'):
+        with self.lock, self.db:
+            self.db.execute('UPDATE records SET synced = published WHERE r = ? AND ps = ? AND freq = ? AND px = ?',
+                            (reporter, period, freq, px))
+
+_availability_store = None
+
+def availability_store():
+    global _availability_store
+    if _availability_store is None:
+        _availability_store = AvailabilityStore()
+    return _availability_store
+
+bulk_dest = '//172.20.23.190/ds/Raw Data/UN_Comtrade/complete_year_data/'
+bulk_columns = ['Classification',
+                'Trade Flow Code',
+                'Reporter Code',
+                'Partner Code',
+                'Commodity Code',
+                'Qty Unit Code',
+                'Qty',
+                'Netweight (kg)',
+                'Trade Value (US$)']
+bulk_chunk_rows = 500000
+
+# Outputs for bulk_dest are written to local scratch first (staging_dir,
+# None for a directory in cache_dir), compressed with publish_compression
+# ('gzip', 'zstd' or None) and then copied over in publish_chunk_size
+# blocks under a temporary name that is renamed into place, next to a
+# manifest with the size and checksum. A file without its manifest is
+# incomplete.
+staging_dir = None
+publish_compression = 'gzip'
+publish_chunk_size = 64 * 1024 ** 2
+# Default of the compression arguments below, so that an explicit None
+# publishes uncompressed.
+_publish_default = object()
+
+class StagedFile:
+    """
+    Binary file written to local scratch and published to dest by
+    publish(). The published name gets the compression's extension.
+    compression is 'gzip', 'zstd' or None; publish_compression if not given.
+    """
+    
+    extensions = {'gzip': '.gz', 'zstd': '.zst', None: ''}
+    
+    def __init__(self, dest, compression = _publish_default):
+        if compression is _publish_default:
+            compression = publish_compression
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('zstandard is required for zstd compression.')
+        self.compression = compression
+        self.dest = dest + self.extensions[compression]
+        directory = staging_dir or os.path.join(cache_dir, 'staging')
+        os.makedirs(directory, exist_ok = True)
+        fd, self.path = tempfile.mkstemp(prefix = os.path.basename(self.dest) + '.', dir = directory)
+        self.raw = os.fdopen(fd, mode = 'wb')
+        if compression == 'gzip':
+            self.file = gzip.GzipFile(fileobj = self.raw, mode = 'wb', compresslevel = 6)
+        elif compression == 'zstd':
+            self.file = zstandard.ZstdCompressor(level = 10, threads = -1).stream_writer(self.raw, closefd = False)
+        else:
+            self.file = self.raw
+        self.size = 0
+    
+    def write(self, data):
+        self.size += len(data)
+        self.file.write(data)
+    
+    def _close(self):
+        if self.file is not self.raw:
+            self.file.close()
+        self.raw.close()
+    
+    def publish(self, **details):
+        """
+        Copy the staged file to dest under a temporary name, rename it into
+        place and write its manifest; details are added to the manifest.
+        Return the published file name.
+        """
+        self._close()
+        partial = self.dest + '.partial'
+        checksum = hashlib.sha256()
+        with open(self.path, mode = 'rb') as source, open(partial, mode = 'wb') as target:
+            while True:
+                block = source.read(publish_chunk_size)
+                if not block:
+                    break
+                checksum.update(block)
+                target.write(block)
+            target.flush()
+            os.fsync(target.fileno())
+        os.replace(partial, self.dest)
+        manifest = dict(details,
+                        file = os.path.basename(self.dest),
+                        compression = self.compression,
+                        size = os.path.getsize(self.dest),
+                        uncompressed_size = self.size,
+                        sha256 = checksum.hexdigest(),
+                        published = datetime.datetime.now().isoformat(timespec = 'seconds'))
+        _write_json(self.dest + '.manifest.json', manifest)
+        os.remove(self.path)
+        return self.dest
+    
+    def discard(self):
+        self._close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def verify_published(filename):
+    """Check a published file against its manifest. Return True if it matches."""
+    try:
+        manifest = _read_json(filename + '.manifest.json')
+    except OSError:
+        return False
+    checksum = hashlib.sha256()
+    with open(filename, mode = 'rb') as file:
+        for block in iter(lambda: file.read(publish_chunk_size), b''):
+            checksum.update(block)
+    return checksum.hexdigest() == manifest['sha256']
+
+def _unzip_stream(chunks):
+    """
+    Yield the uncompressed bytes of the first member of a zip archive read
+    from an iterable of byte chunks, without holding the archive in memory.
+    Input that is not a zip archive is passed through unchanged.
+    """
+    chunks = iter(chunks)
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= 30:
+            break
+    if buffer[:4] != b'PK\x03\x04':
+        yield buffer
+        yield from chunks
+        return
+    
+    if len(buffer) < 30:
+        raise ValueError('Zip archive ended inside the local file header.')
+    header = struct.unpack('<IHHHHHIIIHH', buffer[:30])
+    flags, method, compressed_size, name_length, extra_length = header[2], header[3], header[7], header[9], header[10]
+    skip = 30 + name_length + extra_length
+    while len(buffer) < skip:
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError('Zip archive ended inside the local file header.')
+        buffer += chunk
+    buffer = buffer[skip:]
+    if method == 0:
+        # Stored member, the size is in the header unless it was written in
+        # streaming mode (flag bit 3), when it only follows the data.
+        if flags & 0x08:
+            raise ValueError('Stored zip member without its size in the local header.')
+        remaining = compressed_size
+        for chunk in itertools.chain([buffer], chunks):
+            if remaining <= 0:
+                return
+            yield chunk[:remaining]
+            remaining -= len(chunk)
+        if remaining > 0:
+            raise ValueError('Zip archive ended ' + str(remaining) + ' bytes early.')
+        return
+    if method != 8:
+        raise ValueError('Unsupported zip compression method ' + str(method) + '.')
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    for chunk in itertools.chain([buffer], chunks):
+        yield decompressor.decompress(chunk)
+        if decompressor.eof:
+            return
+    raise ValueError('Zip archive ended before the end of the compressed data.')
+
+class _ChunkReader(io.RawIOBase):
+    """Readable file object over an iterable of byte chunks."""
+    
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = b''
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, buffer):
+        while not self.pending:
+            self.pending = next(self.chunks, None)
+            if self.pending is None:
+                self.pending = b''
+                return 0
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+def download_bulk(year = datetime.datetime.now().year - 1, reduce = True, compression = _publish_default):
+    """
+    Download the complete HS data for one year into bulk_dest.
+    The archive is streamed, unzipped on the fly and written out in chunks
+    of bulk_chunk_rows rows, so memory use does not grow with the file.
+    With reduce = True only bulk_columns are kept.
+    The file is staged locally, compressed (publish_compression by default,
+    None for none) and published with a manifest; the published name is
+    returned.
+    """
+    token = _acquire('bulk')
+    url = base_url + '/api/get/bulk/C/A/{}/ALL/HS?token={}'.format(year, token)
+    r = session().get(url, stream = True, timeout = timeout)
+    r.raise_for_status()
+    data = _unzip_stream(r.iter_content(chunk_size = 1024 ** 2))
+    
+    staged = StagedFile(bulk_dest + str(year) + '.csv', compression)
+    try:
+        if reduce == False:
+            for chunk in data:
+                staged.write(chunk)
+        else:
+            reader = pd.read_csv(io.BufferedReader(_ChunkReader(data), buffer_size = 1024 ** 2),
+                                 usecols = bulk_columns, chunksize = bulk_chunk_rows,
+                                 dtype = {'Commodity Code': str})
+            for i, df in enumerate(reader):
+                staged.write(df.to_csv(index = False, header = i == 0).encode('utf-8'))
+        r.close()
+        filename = staged.publish(year = year, reduced = reduce)
+    except BaseException:
+        staged.discard()
+        raise
+    size = os.path.getsize(filename) / 1024 ** 3
+    print('Successfully downloaded data for {} ({:.2f} GB).'.format(str(year), size))
+    return filename
+
+# Local trade store. Bulk files are loaded into an indexed SQLite database
+# and queries for slices it holds are answered from it instead of the API.
+
+# None means trade.sqlite in cache_dir.
+trade_store_path = None
+use_trade_store = True
+
+class TradeStore:
+    """
+    Trade records in an SQLite file, indexed on reporter, partner, period,
+    flow and commodity code. A coverage table lists the (frequency,
+    period) slices loaded completely from bulk files; queries within
+    them are answered locally, in the CSV layout of the API.
+    """
+    
+    columns = ['freq', 'period', 'flow', 'reporter', 'partner', 'commodity', 'level', 'qty_unit', 'qty',
+               'netweight', 'value', 'classification']
+    
+    def __init__(self, filename = None):
+        filename = filename or trade_store_path or os.path.join(cache_dir, 'trade.sqlite')
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok = True)
+        self.db = sqlite3.connect(filename, check_same_thread = False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS trade (freq TEXT, period INTEGER, flow INTEGER, '
+                            'reporter INTEGER, partner INTEGER, commodity TEXT, level INTEGER, qty_unit INTEGER, '
+                            'qty REAL, netweight REAL, value REAL, classification TEXT)')
+            # Stores created before the classification was kept.
+            if 'classification' not in [x[1] for x in self.db.execute('PRAGMA table_info(trade)')]:
+                self.db.execute('ALTER TABLE trade ADD COLUMN classification TEXT')
+            for column in ['reporter', 'partner', 'period', 'flow', 'commodity']:
+                self.db.execute('CREATE INDEX IF NOT EXISTS trade_{0} ON trade ({0})'.format(column))
+            self.db.execute('CREATE INDEX IF NOT EXISTS trade_slice ON trade (freq, period, reporter, partner)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS coverage (freq TEXT, period TEXT, PRIMARY KEY (freq, period))')
+            self.coverage = set(self.db.execute('SELECT freq, period FROM coverage').fetchall())
+    
+    def load_bulk(self, filename, year, freq = 'A'):
+        """
+        Load a file written by download_bulk (reduced or not) for year,
+        replacing whatever the store held for that period. Files reduced
+        without the Classification column leave it empty.
+        """
+        reader = pd.read_csv(filename, usecols = lambda x: x in bulk_columns, chunksize = bulk_chunk_rows,
+                             dtype = {'Commodity Code': str, 'Classification': str})
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM trade WHERE freq = ? AND period = ?', (freq, int(year)))
+            for df in reader:
+                codes = df['Commodity Code'].fillna('')
+                rows = pd.DataFrame({'freq': freq,
+                                     'period': int(year),
+                                     'flow': df['Trade Flow Code'],
+                                     'reporter': df['Reporter Code'],
+                                     'partner': df['Partner Code'],
+                                     'commodity': codes,
+                                     'level': codes.str.len().where(codes != 'TOTAL', 0),
+                                     'qty_unit': df['Qty Unit Code'],
+                                     'qty': df['Qty'],
+                                     'netweight': df['Netweight (kg)'],
+                                     'value': df['Trade Value (US$)'],
+                                     'classification': df['Classification'] if 'Classification' in df else None})
+                rows = rows.astype(object).where(rows.notna(), None)
+                self.db.executemany('INSERT INTO trade ({}) VALUES ({})'.format(
+                                        ','.join(self.columns), ','.join('?' * len(self.columns))),
+                                    rows.itertuples(index = False, name = None))
+            self.db.execute('INSERT OR IGNORE INTO coverage VALUES (?, ?)', (freq, str(year)))
+        self.coverage.add((freq, str(year)))
+        print('Loaded ' + filename + ' into the trade store.')
+    
+    def covers(self, payload):
+        return (payload.get('px', 'HS') == 'HS' and payload.get('type', 'C') == 'C' and
+                all((payload['freq'], x) in self.coverage for x in payload['ps'].split(',')))
+    
+    def answer(self, payload):
+        """Return the CSV body the API would send for payload, as bytes."""
+        conditions = ['freq = ?', 'period IN ({})'.format(','.join('?' * len(payload['ps'].split(','))))]
+        parameters = [payload['freq']] + [int(x) for x in payload['ps'].split(',')]
+        for key, column in [('r', 'reporter'), ('p', 'partner'), ('rg', 'flow')]:
+            codes = str(payload.get(key, 'all')).split(',')
+            if codes != ['all']:
+                conditions.append('{} IN ({})'.format(column, ','.join('?' * len(codes))))
+                parameters.extend(int(x) for x in codes)
+        cc = str(payload.get('cc', 'ALL'))
+        if re.fullmatch(r'AG\d', cc):
+            conditions.append('level = ?')
+            parameters.append(int(cc[2]))
+        elif cc != 'ALL':
+            codes = cc.split(',')
+            conditions.append('commodity IN ({})'.format(','.join('?' * len(codes))))
+            parameters.extend(codes)
+        with self.lock:
+            rows = self.db.execute('SELECT period, level, flow, reporter, partner, commodity, qty_unit, qty, '
+                                   'netweight, value, classification FROM trade WHERE ' + ' AND '.join(conditions),
+                                   parameters).fetchall()
+        
+        header = list(record_schema)
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator = '\r\n')
+        writer.writerow(header)
+        if not rows:
+            out.write(_no_data_line + '\r\n')
+        fields = ['Period', 'Aggregate Level', 'Trade Flow Code', 'Reporter Code', 'Partner Code',
+                  'Commodity Code', 'Qty Unit Code', 'Qty', 'Netweight (kg)', 'Trade Value (US$)', 'Classification']
+        positions = [header.index(x) for x in fields]
+        for row in rows:
+            record = [''] * len(header)
+            for i, value in zip(positions, row):
+                record[i] = '' if value is None else value
+            record[header.index('Year')] = str(row[0])[:4]
+            writer.writerow(record)
+        return out.getvalue().encode('utf-8')
+    
+    def close(self):
+        self.db.close()
+
+_trade_store = None
+
+def trade_store():
+    global _trade_store
+    if _trade_store is None:
+        _trade_store = TradeStore()
+    return _trade_store
 
 # Entire classification-years may be downloaded.
 # Reporter-classification-years may be accessed as well.
 
+# Reference data (reporter and partner areas) is loaded lazily on first
+# access and kept in a local cache, so importing the module costs no
+# network round-trip and warm starts work offline.
+
+cache_dir = os.path.join(os.path.expanduser('~'), '.uncomtrade')
+reference_ttl = 7 * 24 * 3600
+reference_paths = {'reporter': '/data/cache/reporterAreas.json',
+                   'partner': '/data/cache/partnerAreas.json'}
+_reference = {}
+
+def _read_json(filename):
+    with open(filename, encoding = 'utf-8') as file:
+        return json.load(file)
+
+def _write_json(filename, obj):
+    """Write obj to filename atomically."""
+    os.makedirs(os.path.dirname(filename), exist_ok = True)
+    tmp = filename + '.tmp'
+    with open(tmp, encoding = 'utf-8', mode = 'w') as file:
+        json.dump(obj, file)
+    os.replace(tmp, filename)
+
+def _fetch_reference(url, offline = False):
+    """
+    Return the parsed JSON of a reference file, going through the local cache.
+    A cached copy younger than reference_ttl is used as is. An older one is
+    revalidated with its ETag/Last-Modified and kept when the server answers
+    304 or cannot be reached. With offline = True the network is never used.
+    """
+    filename = os.path.join(cache_dir, url.rsplit('/', 1)[-1])
+    meta_filename = filename + '.meta'
+    cached = os.path.isfile(filename)
+    if cached and (offline or time() - os.path.getmtime(filename) < reference_ttl):
+        return _read_json(filename)
+    if offline:
+        raise FileNotFoundError('No cached reference data at ' + filename + '.')
+    
+    headers = {}
+    if cached and os.path.isfile(meta_filename):
+        meta = _read_json(meta_filename)
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    try:
+        resp = session().get(url, headers = headers, timeout = timeout)
+        if resp.status_code != 304:
+            resp.raise_for_status()
+    except requests.RequestException:
+        if cached:
+            return _read_json(filename)
+        raise
+    if resp.status_code == 304:
+        os.utime(filename)
+        return _read_json(filename)
+    
+    parsed_json = json.loads(resp.content.decode('utf-8-sig'))
+    _write_json(filename, parsed_json)
+    _write_json(meta_filename, {'etag': resp.headers.get('ETag'),
+                                'last_modified': resp.headers.get('Last-Modified')})
+    return parsed_json
+
+def _reference_data(kind, offline = False):
+    """
+    Return the reference data for kind ('reporter' or 'partner') as a dict
+    with the id list, the id -> name dict and the name -> id dict.
+    """
+    if kind not in _reference:
+        results = _fetch_reference(base_url + reference_paths[kind], offline = offline)['results']
+        excluded = ['all'] if kind == 'reporter' else ['all', '0']
+        names = {x['id']: x['text'] for x in results[1:]}
+        _reference[kind] = {'list': [x['id'] for x in results if x['id'] not in excluded],
+                            'dict': names,
+                            'reverse': {v: k for k, v in names.items()}}
+    return _reference[kind]
+
+def get_reporters():
+    reference = _reference_data('reporter')
+    return([reference['list'], reference['dict']])
+
+def get_partners():
+    reference = _reference_data('partner')
+    return([reference['list'], reference['dict']])
+
+def __getattr__(name):
+    # reporter_list, reporter_dict, partner_list and partner_dict used to be
+    # filled at import time; they are now resolved on first access.
+    lazy = {'reporter_list': ('reporter', 'list'),
+            'reporter_dict': ('reporter', 'dict'),
+            'partner_list': ('partner', 'list'),
+            'partner_dict': ('partner', 'dict')}
+    if name in lazy:
+        kind, key = lazy[name]
+        return _reference_data(kind)[key]
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+# Instrumentation. Requests, retries, waits and parsed rows are counted in
+# metrics; with metrics_log set to a file name every event is also appended
+# to it as one JSON line. Crawls print their progress and an ETA over the
+# planned query units when show_progress is set.
+
+metrics_log = None
+show_progress = True
+
+class Histogram:
+    """
+    Count, total and maximum of every observed value, and percentiles over
+    the latest window of them.
+    """
+    
+    def __init__(self, window = 10000):
+        self.count = 0
+        self.total = 0
+        self.max = None
+        self.recent = collections.deque(maxlen = window)
+    
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = value if self.max is None else max(self.max, value)
+        self.recent.append(value)
+    
+    def summary(self):
+        values = sorted(self.recent)
+        def percentile(q):
+            return values[min(len(values) - 1, int(q * len(values)))] if values else None
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total / self.count if self.count else None,
+                'p50': percentile(0.5),
+                'p90': percentile(0.9),
+                'p99': percentile(0.99),
+                'max': self.max}
+
+class Metrics:
+    """
+    Counters and histograms shared by every request sent through the
+    module. Request times of the last hour are kept to tell how much of the
+    hourly quota is left.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.log = None
+        self.log_name = None
+        self.reset()
+    
+    def reset(self):
+        with self.lock:
+            self.counters = collections.Counter()
+            self.histograms = collections.defaultdict(Histogram)
+            self.sent = collections.deque()
+            self.started = monotonic()
+    
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] += n
+    
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms[name].add(value)
+    
+    def request_sent(self, kind = 'data'):
+        """Record a request spending quota; kind is data, availability or bulk."""
+        with self.lock:
+            now = monotonic()
+            self.sent.append(now)
+            while now - self.sent[0] > 3600:
+                self.sent.popleft()
+            self.counters['requests'] += 1
+            self.counters['requests.' + kind] += 1
+    
+    def quota_remaining(self):
+        """Requests left in the hourly budget over the last hour."""
+        if token_pool is not None:
+            budget = sum(x.rate * 3600 for token, x in token_pool.limiters.items()
+                         if token not in token_pool.rejected)
+        else:
+            budget = rate_limiter.rate * 3600
+        with self.lock:
+            now = monotonic()
+            return max(0, int(budget) - sum(1 for x in self.sent if now - x <= 3600))
+    
+    def event(self, kind, **fields):
+        """Append an event to metrics_log, if set."""
+        if metrics_log is None:
+            return
+        line = json.dumps(dict(fields, time = time(), event = kind)) + '\n'
+        with self.lock:
+            if self.log_name != metrics_log:
+                if self.log is not None:
+                    self.log.close()
+                self.log = open(metrics_log, encoding = 'utf-8', mode = 'a')
+                self.log_name = metrics_log
+            self.log.write(line)
+            self.log.flush()
+    
+    def summary(self):
+        """Return the counters, histogram summaries and remaining quota."""
+        quota = self.quota_remaining()
+        with self.lock:
+            return {'seconds': monotonic() - self.started,
+                    'counters': dict(self.counters),
+                    'histograms': {k: v.summary() for k, v in self.histograms.items()},
+                    'quota_remaining': quota}
+
+metrics = Metrics()
+
+class Progress:
+    """
+    Query units of one crawl: planned, done and rows received, with the
+    throughput so far and the time left at that pace. Units added by
+    splitting truncated results count as planned work. total may be None
+    when the number of units is not known in advance.
+    """
+    
+    def __init__(self, total = None):
+        self.total = total
+        self.done = 0
+        self.rows = 0
+        self.started = monotonic()
+        self.lock = threading.Lock()
+    
+    def add(self, n):
+        with self.lock:
+            if self.total is not None:
+                self.total += n
+    
+    def update(self, rows):
+        with self.lock:
+            self.done += 1
+            self.rows += rows
+    
+    def eta(self):
+        """Seconds left at the pace so far, or None if unknown."""
+        with self.lock:
+            if self.total is None or self.done == 0:
+                return None
+            return (monotonic() - self.started) / self.done * (self.total - self.done)
+    
+    def __str__(self):
+        elapsed = max(monotonic() - self.started, 1e-9)
+        eta = self.eta()
+        text = '{} of {} units'.format(self.done, '?' if self.total is None else self.total)
+        if self.total:
+            text += ' ({:.0%})'.format(self.done / self.total)
+        text += ', {:.0f} rows/s'.format(self.rows / elapsed)
+        if eta is not None:
+            text += ', ETA ' + str(datetime.timedelta(seconds = round(eta)))
+        return text
+
 # Rate limit: none
 # Usage limit: 1000 requests per hour
 # (per authorization code or IP address if no authorization code is used).
+# The server may still answer "RATE LIMIT: You must wait N seconds.".
 
-def get_reporters():
+class RateLimiter:
+    """
+    Token bucket shared by every request sent to the API.
+    Tokens are refilled at hourly_budget per hour and at most burst of them
+    may be spent at once. A rate limit reply from the server blocks the
+    bucket for the number of seconds it asks for.
+    """
+    
+    def __init__(self, hourly_budget = 1000, burst = 5):
+        self.rate = hourly_budget / 3600
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+    
+    def reserve(self):
+        """Take one token and return the seconds to wait before using it."""
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate, self.blocked_until - now)
     
-    url = 'http://comtrade.un.org/data/cache/reporterAreas.json'
-    resp = requests.get(url)
-    parsed_json = json.loads(resp.text)
-    reporter_dict = parsed_json['results']
-    reporter_df = pd.DataFrame(reporter_dict)
-    reporter_array = reporter_df['id'].values
-    reporter_list = [c for c in reporter_array if c != 'all']
-	
-    d = {reporter_dict[i]['id']: reporter_dict[i]['text'] for i in range(1, len(reporter_dict))}
-    return([reporter_list, d])
+    def available_in(self):
+        """Return the seconds until a token is free, without taking it."""
+        with self.lock:
+            now = monotonic()
+            tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            return max(0, (1 - tokens) / self.rate, self.blocked_until - now)
+    
+    def acquire(self):
+        sleep(self.reserve())
+    
+    def penalize(self, seconds):
+        """Hold every request back for the given number of seconds."""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, monotonic() + seconds)
 
-def get_partners():
+rate_limiter = RateLimiter()
+
+class TokenPool:
+    """
+    Several subscription tokens, each with its own RateLimiter, so that
+    hourly capacity grows with the number of tokens. Every request goes to
+    the token that can be used soonest; a throttled token is held back for
+    the time the server asks and a rejected one is retired from the pool.
+    """
+    
+    def __init__(self, tokens, hourly_budget = 1000, burst = 5):
+        self.limiters = {x: RateLimiter(hourly_budget, burst) for x in tokens}
+        self.rejected = set()
+        self.sent = collections.Counter()
+        self.throttled = collections.Counter()
+        self.started = monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Wait for quota on the token available soonest and return it."""
+        with self.lock:
+            active = [x for x in self.limiters if x not in self.rejected]
+            if not active:
+                raise AuthenticationError('Every token in the pool has been rejected.')
+            token = min(active, key = lambda x: self.limiters[x].available_in())
+            wait = self.limiters[token].reserve()
+            self.sent[token] += 1
+        sleep(wait)
+        return token
+    
+    def penalize(self, token, seconds):
+        with self.lock:
+            self.throttled[token] += 1
+        self.limiters[token].penalize(seconds)
+    
+    def reject(self, token):
+        with self.lock:
+            self.rejected.add(token)
+    
+    def report(self):
+        """Return requests sent and requests per hour, per token and in total."""
+        hours = max(monotonic() - self.started, 1) / 3600
+        with self.lock:
+            tokens = {x[:6] + '...': {'requests': self.sent[x],
+                                      'per_hour': self.sent[x] / hours,
+                                      'throttled': self.throttled[x],
+                                      'rejected': x in self.rejected} for x in self.limiters}
+            total = sum(self.sent.values())
+        return {'tokens': tokens, 'requests': total, 'per_hour': total / hours}
+
+# Set token_pool = TokenPool([...]) to spread requests over several tokens;
+# otherwise auth_code and rate_limiter are used.
+token_pool = None
+
+def _acquire(kind = 'data'):
+    """
+    Wait for quota and return the token to send with the next request.
+    Every call spends quota and is recorded in metrics under kind.
+    """
+    started = monotonic()
+    if token_pool is not None:
+        token = token_pool.acquire()
+    else:
+        rate_limiter.acquire()
+        token = auth_code
+    wait = monotonic() - started
+    metrics.observe('quota_wait_seconds', wait)
+    metrics.request_sent(kind)
+    metrics.event('acquire', request = kind, wait = wait)
+    return token
+
+def _penalize(token, seconds):
+    if token_pool is not None:
+        token_pool.penalize(token, seconds)
+    else:
+        rate_limiter.penalize(seconds)
+_rate_limit_reply = re.compile(r'RATE LIMIT: You must wait (\d+) seconds')
+
+# Transport. All calls share one pooled keep-alive session that asks for
+# compressed responses. Failures are classified, and each retryable class
+# has its own jittered exponential backoff.
+
+timeout = (10, 300)
+_session = None
+
+def session():
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 4, pool_maxsize = 32)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+        _session.headers['Accept-Encoding'] = 'gzip, deflate'
+    return _session
+
+class ComtradeError(Exception):
+    """Base class for failed or unusable API answers."""
+
+class RateLimitError(ComtradeError):
+    """The server asked to wait before the next request."""
     
-    url = 'http://comtrade.un.org/data/cache/partnerAreas.json'
-    resp = requests.get(url)
-    parsed_json = json.loads(resp.text)
-    partner_dict = parsed_json['results']
-    partner_df = pd.DataFrame(partner_dict)
-    partner_array = partner_df['id'].values
-    partner_list = [c for c in partner_array if c != 'all' and c != '0']
+    def __init__(self, message, wait):
+        super().__init__(message)
+        self.wait = wait
+
+class ServerError(ComtradeError):
+    """The server failed to answer the query."""
+
+class EmptyResultError(ComtradeError):
+    """No data matches the query."""
+
+class TruncatedResultError(ComtradeError):
+    """The result was cut off at the row cap."""
+
+class AuthenticationError(ComtradeError):
+    """The token was rejected."""
+
+class TransportError(ComtradeError):
+    """The request did not get an answer (connection error, timeout)."""
+
+class ClientError(ComtradeError):
+    """The server rejected the query itself (HTTP 4xx); retrying will not help."""
+
+class Backoff:
+    """
+    Jittered exponential backoff: retry n waits a random time of up to
+    min(cap, base * 2 ** n) seconds. After attempts retries the error is
+    raised; None retries forever.
+    """
+    
+    def __init__(self, base, cap, attempts = None):
+        self.base = base
+        self.cap = cap
+        self.attempts = attempts
     
-    d = {partner_dict[i]['id']: partner_dict[i]['text'] for i in range(1, len(partner_dict))}
-    return([partner_list, d])
+    def delay(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
 
-reporter_list = get_reporters()[0]
-reporter_dict =  get_reporters()[1]
-partner_list = get_partners()[0]
-partner_dict =  get_partners()[1]
-url = 'http://comtrade.un.org/api/get?'
+retry_policies = {RateLimitError: Backoff(1, 30),
+                  ServerError: Backoff(5, 300, attempts = 10),
+                  TransportError: Backoff(1, 120, attempts = 10)}
 
+def _retry_after(resp, default = 60):
+    """Seconds to wait according to a Retry-After header (seconds or HTTP date)."""
+    value = getattr(resp, 'headers', {}).get('Retry-After', '')
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+        return max(0, int((when - datetime.datetime.now(datetime.timezone.utc)).total_seconds()))
+    except (TypeError, ValueError):
+        return default
 
-def get_taiwan(year, month):
+def classify(resp, payload = None):
     """
-    Retrieve import data of all reporting countries where Taiwan is
-    partner country.
-    One file per month, loop over all reporting countries.
+    Return the ComtradeError describing a response, or None if it is a
+    usable, complete answer to payload.
     """
+    text = resp.text
+    wait = _rate_limit_reply.match(text)
+    if wait:
+        return RateLimitError(text, int(wait.group(1)))
+    status = getattr(resp, 'status_code', 200)
+    if status in (401, 403):
+        return AuthenticationError(text or 'HTTP ' + str(status))
+    if status == 429:
+        return RateLimitError(text or 'HTTP 429', _retry_after(resp))
+    if status >= 500 or text.startswith('{"Message":"An error has occurred.'):
+        return ServerError(text or 'HTTP ' + str(status))
+    if status >= 400:
+        return ClientError('HTTP ' + str(status) + (': ' + text[:200] if text else ''))
+    if _no_data(text):
+        return EmptyResultError(text)
+    if payload is not None and _row_count(resp.text) >= int(payload.get('max', max_rows)):
+        return TruncatedResultError('Result truncated at ' + str(payload.get('max', max_rows)) + ' rows.')
+    return None
+
+
+# Response cache. Answers are stored compressed on disk, keyed on the
+# normalized query, so overlapping or repeated jobs do not spend quota on
+# data already downloaded. "No data matches" answers are kept as well.
+
+response_cache_size = 2 * 1024 ** 3
+class CachedResponse(collections.namedtuple('CachedResponse', ['content'])):
     
-    filename = str(year) + '-' + str(month).zfill(2) + '.csv'
-    file = open(filename, encoding = 'utf-8', mode = 'w', newline = '')
-    
-    # Iteration part
-    counter = 0
-    for i in range(0, len(reporter_list) // 5 * 5 - 5 + 1, 5):
-        country_group = ','.join(reporter_list[i : i + 5])
-        payload = {'max': 50000,
-                   'type': 'C',
-                   'freq': 'M',
-                   'px': 'HS',
-                   'ps': str(year) + str(month).zfill(2),
-                   'r': country_group,
-                   'p': '490',
-                   'rg': '1',
-                   'cc': 'AG6',
-                   'fmt': 'csv'
-        }
-        while True:
-            try:
-                resp = requests.get(url + urllib.parse.urlencode(payload))
-                if resp.text != '{"Message":"An error has occurred."}' and resp.text != 'RATE LIMIT: You must wait 1 seconds.':
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+def _period_ttl(periods):
+    """
+    Return how long, in seconds, answers for the given periods stay fresh,
+    or None if they never expire. Data for recent years is still revised,
+    closed years are not.
+    """
+    age = datetime.datetime.now().year - max(int(x[:4]) for x in periods.split(','))
+    if age >= 3:
+        return None
+    if age == 2:
+        return 30 * 24 * 3600
+    return 24 * 3600
+
+class ResponseCache:
+    """
+    Responses to API queries, stored gzip-compressed under directory and
+    named by the hash of their normalized query parameters.
+    An SQLite index keeps size, last access and expiry of every entry, and
+    the least recently used ones are evicted beyond max_size bytes.
+    """
+    
+    parameters = ['type', 'freq', 'px', 'ps', 'r', 'p', 'rg', 'cc', 'fmt', 'max']
+    
+    def __init__(self, directory = None, max_size = None):
+        self.directory = directory or os.path.join(cache_dir, 'responses')
+        self.max_size = max_size or response_cache_size
+        os.makedirs(self.directory, exist_ok = True)
+        self.db = sqlite3.connect(os.path.join(self.directory, 'index.sqlite'), check_same_thread = False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, '
+                            'accessed REAL, expires REAL, empty INTEGER)')
+    
+    @classmethod
+    def key(cls, payload):
+        normalized = {x: ','.join(sorted(str(payload[x]).split(','))) for x in cls.parameters if x in payload}
+        return hashlib.sha256(json.dumps(normalized, sort_keys = True).encode('utf-8')).hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.gz')
+    
+    def get(self, payload):
+        """Return the cached response body for payload, or None."""
+        key = self.key(payload)
+        with self.lock, self.db:
+            entry = self.db.execute('SELECT expires FROM entries WHERE key = ?', (key,)).fetchone()
+            if entry is None or (entry[0] is not None and entry[0] < time()):
+                return None
+            self.db.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time(), key))
+        try:
+            with gzip.open(self._path(key), mode = 'rb') as file:
+                return file.read()
+        except OSError:
+            return None
+    
+    def put(self, payload, content):
+        key = self.key(payload)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        tmp = path + '.' + str(threading.get_ident()) + '.tmp'
+        with gzip.open(tmp, mode = 'wb') as file:
+            file.write(content)
+        os.replace(tmp, path)
+        ttl = _period_ttl(payload['ps'])
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                            (key, os.path.getsize(path), time(), None if ttl is None else time() + ttl,
+                             int(_no_data(content[:4096].decode('utf-8', 'ignore')))))
+        self.evict()
+    
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_size."""
+        with self.lock, self.db:
+            total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total <= self.max_size:
+                return
+            for key, size in self.db.execute('SELECT key, size FROM entries ORDER BY accessed').fetchall():
+                if total <= self.max_size * 0.9:
                     break
-            except:
-                sleep(1)
-            else:
-                if resp.text == '{"Message":"An error has occurred."}':
-                    print('An error has occurred with message:\n' + resp.text)
-                    sleep(600)
-                if resp.text == 'RATE LIMIT: You must wait 1 seconds.':
-                    print('An error has occurred with message:\n' + resp.text)
-                    sleep(5)
-        if resp.text.split(sep = '\r\n')[1] == 'No data matches your query or your query is too complex. Request JSON or XML format for more information.,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,':
-            print('No data matches for ' + country_group + '.')
-            sleep(37)
+                self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+                total -= size
+
+use_response_cache = True
+_response_cache = None
+
+def response_cache():
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+    return _response_cache
+
+def _request(payload, refresh = False):
+    """
+    Send one query to the API through the shared rate limiter and return the
+    response, retrying rate limit replies, server errors and transport
+    failures according to retry_policies.
+    Answers found in the response cache, and queries the local trade store
+    covers, are returned without a request unless refresh is set.
+    """
+    if use_response_cache and not refresh:
+        content = response_cache().get(payload)
+        if content is not None:
+            metrics.count('cache_hits')
+            return CachedResponse(content)
+    if use_trade_store and not refresh and (_trade_store is not None or
+            os.path.isfile(trade_store_path or os.path.join(cache_dir, 'trade.sqlite'))) and \
+            trade_store().covers(payload):
+        metrics.count('store_hits')
+        return CachedResponse(trade_store().answer(payload))
+    attempts = collections.Counter()
+    while True:
+        token = _acquire()
+        query = dict(payload, token = token) if token else payload
+        started = monotonic()
+        try:
+            resp = session().get(base_url + '/api/get?' + urllib.parse.urlencode(query), timeout = timeout)
+            error = classify(resp)
+        except requests.RequestException as e:
+            resp = None
+            error = TransportError(str(e))
+        seconds = monotonic() - started
+        metrics.observe('request_seconds', seconds)
+        if resp is not None:
+            metrics.observe('response_bytes', len(resp.content))
+        if isinstance(error, EmptyResultError):
+            metrics.count('empty_results')
+        elif error is not None:
+            metrics.count('errors.' + type(error).__name__)
+        metrics.event('request', r = payload.get('r'), p = payload.get('p'), ps = payload.get('ps'),
+                      status = getattr(resp, 'status_code', None), seconds = seconds,
+                      bytes = len(resp.content) if resp is not None else 0,
+                      error = type(error).__name__ if error is not None else None)
+        if isinstance(error, AuthenticationError) and token_pool is not None:
+            # Fail over to the other tokens.
+            print('Token ' + token[:6] + '... was rejected with message:\n' + str(error))
+            token_pool.reject(token)
             continue
+        if isinstance(error, (AuthenticationError, ClientError)):
+            # Never cached or retried.
+            raise error
+        policy = retry_policies.get(type(error))
+        if policy is None:
+            break
+        if policy.attempts is not None and attempts[type(error)] >= policy.attempts:
+            raise error
+        delay = policy.delay(attempts[type(error)])
+        if isinstance(error, RateLimitError):
+            delay += error.wait
+            _penalize(token, delay)
+        print('An error has occurred with message:\n' + str(error) +
+            '\nRetrying in {:.0f} seconds.'.format(delay))
+        metrics.count('retries.' + type(error).__name__)
+        metrics.event('retry', error = type(error).__name__, message = str(error), delay = delay)
+        if not isinstance(error, RateLimitError):
+            metrics.observe('backoff_seconds', delay)
+            sleep(delay)
+        attempts[type(error)] += 1
+    if use_response_cache:
+        response_cache().put(payload, resp.content)
+    return resp
+
+
+# Concurrent fetch engine. Requests are still paced by rate_limiter, but up
+# to concurrency of them are in flight at once and responses are written out
+# while the next ones are pending.
+
+concurrency = 4
+_no_data_line = 'No data matches your query or your query is too complex. Request JSON or XML format for more information.,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,'
+
+def _no_data(text):
+    lines = text.split(sep = '\r\n', maxsplit = 2)
+    return len(lines) > 1 and lines[1] == _no_data_line
+
+def _chunks(items, size):
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+# Record schema. Comtrade CSV rows are parsed straight from the response
+# bytes into compact types: codes as small integers, HS codes as integers
+# (zero-pad to six digits to print them), descriptions as categoricals and
+# quantities and values as nullable floats.
+
+record_schema = {'Classification': 'category',
+                 'Year': 'Int16',
+                 'Period': 'Int32',
+                 'Period Desc.': 'category',
+                 'Aggregate Level': 'Int8',
+                 'Is Leaf Code': 'Int8',
+                 'Trade Flow Code': 'Int8',
+                 'Trade Flow': 'category',
+                 'Reporter Code': 'Int16',
+                 'Reporter': 'category',
+                 'Reporter ISO': 'category',
+                 'Partner Code': 'Int16',
+                 'Partner': 'category',
+                 'Partner ISO': 'category',
+                 '2nd Partner Code': 'Int16',
+                 '2nd Partner': 'category',
+                 '2nd Partner ISO': 'category',
+                 'Customs Proc. Code': 'category',
+                 'Customs': 'category',
+                 'Mode of Transport Code': 'category',
+                 'Mode of Transport': 'category',
+                 'Commodity Code': 'Int32',
+                 'Commodity': 'category',
+                 'Qty Unit Code': 'Int8',
+                 'Qty Unit': 'category',
+                 'Qty': 'Float64',
+                 'Alt Qty Unit Code': 'Int8',
+                 'Alt Qty Unit': 'category',
+                 'Alt Qty': 'Float64',
+                 'Netweight (kg)': 'Float64',
+                 'Gross weight (kg)': 'Float64',
+                 'Trade Value (US$)': 'Float64',
+                 'CIF Trade Value (US$)': 'Float64',
+                 'FOB Trade Value (US$)': 'Float64',
+                 'Flag': 'Int8'}
+
+def parse_records(content, usecols = None):
+    """
+    Parse a CSV response body (bytes) into a DataFrame typed after
+    record_schema. The header is consumed by the parser, the body is not
+    copied or split into lines first.
+    Commodity codes that are not numeric, such as TOTAL, become missing.
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    dtype = {k: v for k, v in record_schema.items() if usecols is None or k in usecols}
+    # The parser builds categoricals itself but reads numbers with its own
+    # types; converting those afterwards is much faster than having it build
+    # nullable arrays from strings. Commodity codes are read as text so that
+    # TOTAL does not abort parsing.
+    native = {k: v for k, v in dtype.items() if v == 'category'}
+    if 'Commodity Code' in dtype:
+        native['Commodity Code'] = str
+    df = pd.read_csv(io.BytesIO(content), dtype = native, usecols = usecols, engine = 'c')
+    if len(df) == 1 and _no_data(content[:4096].decode('utf-8', 'ignore')):
+        df = df.iloc[0:0]
+    if 'Commodity Code' in df:
+        df['Commodity Code'] = pd.to_numeric(df['Commodity Code'], errors = 'coerce')
+    return df.astype({k: v for k, v in dtype.items() if k in df})
+
+# Output sinks. The fetch loops hand every response to sink.write(payload,
+# resp); sync() makes what was written durable and returns the committed
+# size of the output, which the checkpoint records.
+
+class CsvSink:
+    """
+    Append CSV responses to one file, keeping only the first header.
+    With offset, an existing file is truncated to that size and appended
+    to, as when resuming from a checkpoint.
+    """
+    
+    def __init__(self, filename, offset = None):
+        self.file = open(filename, mode = 'wb' if offset is None else 'ab')
+        if offset is not None:
+            self.file.truncate(offset)
+            self.file.seek(0, os.SEEK_END)
+        self.header = self.file.tell() == 0
+        self.lock = threading.Lock()
+    
+    def write(self, payload, resp):
         data = resp.text
-        if counter != 0:
-            with_header = data.split(sep = '\r\n')
-            header_removed = [with_header[x] for x in range(len(with_header)) if x != 0]
-            data = '\r\n'.join(header_removed)
-        file.write(data)
-        print('Data for ' + country_group + ' written on ' + 
-            strftime("%Y-%m-%d %H:%M:%S") + '.')
-        counter += 1
-        sleep(37)
-    
-    # Last iteration
-    country_group = ','.join(reporter_list[len(reporter_list) // 5 * 5 : len(reporter_list)])
-    payload = {'max': 50000,
-               'type': 'C',
-               'freq': 'M',
-               'px': 'HS',
-               'ps': str(year) + str(month).zfill(2),
-               'r': country_group,
-               'p': '490',
-               'rg': '1',
-               'cc': 'AG6',
-               'fmt': 'csv'
-    }
-    while True:
+        if _no_data(data):
+            return
+        with self.lock:
+            if not self.header:
+                data = data.partition('\r\n')[2]
+            self.file.write(data.encode('utf-8'))
+            self.header = False
+    
+    def sync(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            return self.file.tell()
+    
+    def close(self):
+        self.file.close()
+
+class ParquetSink:
+    """
+    Write responses as Parquet files partitioned by frequency, period and
+    reporter (root/freq=M/period=201501/reporter=842/...), compressed and
+    with row group statistics, so readers can prune partitions and columns.
+    Each query unit goes to its own file, named after the unit, so a unit
+    written twice replaces its earlier output. Requires pyarrow.
+    """
+    
+    def __init__(self, root, compression = 'zstd', row_group_size = 100000):
+        if pyarrow is None:
+            raise ImportError('ParquetSink requires pyarrow.')
+        self.root = root
+        self.compression = compression
+        self.row_group_size = row_group_size
+    
+    def write(self, payload, resp):
+        if _no_data(resp.text):
+            return
+        df = parse_records(resp.content)
+        name = hashlib.sha1(Checkpoint.key(payload).encode('utf-8')).hexdigest() + '.parquet'
+        for (period, reporter), part in df.groupby(['Period', 'Reporter Code']):
+            directory = os.path.join(self.root, 'freq=' + payload['freq'], 'period=' + str(period),
+                                     'reporter=' + str(reporter))
+            os.makedirs(directory, exist_ok = True)
+            table = pyarrow.Table.from_pandas(part, preserve_index = False)
+            tmp = os.path.join(directory, '.' + name + '.tmp')
+            pyarrow.parquet.write_table(table, tmp, compression = self.compression,
+                                        row_group_size = self.row_group_size, write_statistics = True)
+            os.replace(tmp, os.path.join(directory, name))
+    
+    def sync(self):
+        return 0
+    
+    def close(self):
+        pass
+
+class CsvPartSink:
+    """
+    Write each query unit's CSV response to its own file in directory,
+    named after the unit. Files appear atomically, and a unit written twice
+    (for instance by two workers) replaces its earlier output.
+    """
+    
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok = True)
+    
+    @staticmethod
+    def name(payload):
+        return hashlib.sha1(Checkpoint.key(payload).encode('utf-8')).hexdigest() + '.csv'
+    
+    def write(self, payload, resp):
+        if _no_data(resp.text):
+            return
+        path = os.path.join(self.directory, self.name(payload))
+        tmp = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+        with open(tmp, mode = 'wb') as file:
+            file.write(resp.content)
+        os.replace(tmp, path)
+    
+    def sync(self):
+        return 0
+    
+    def close(self):
+        pass
+
+class RollupSink:
+    """
+    Keep HS2, HS4 and total sums of the HS6 records written to it in an
+    SQLite file (rollup.sqlite in cache_dir by default), per frequency,
+    period, flow, reporter and partner. Each response replaces the sums of
+    the reporter, partner, period and flow cells its query covers, so a
+    re-fetched unit updates the cube instead of adding to it. Use it on its
+    own or next to another sink with TeeSink, and read it with query().
+    Only queries for whole cells (cc AG6 or ALL) can be written to it: a
+    response for some commodity codes would replace the sums of the whole
+    cell with the sums of those codes.
+    """
+    
+    levels = {2: 10000, 4: 100, 0: None}
+    
+    def __init__(self, filename = None):
+        filename = filename or os.path.join(cache_dir, 'rollup.sqlite')
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok = True)
+        self.db = sqlite3.connect(filename, check_same_thread = False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS rollup (freq TEXT, period INTEGER, flow INTEGER, '
+                            'reporter INTEGER, partner INTEGER, level INTEGER, code TEXT, qty REAL, '
+                            'netweight REAL, value REAL, records INTEGER, '
+                            'PRIMARY KEY (freq, period, flow, reporter, partner, level, code))')
+            self.db.execute('CREATE INDEX IF NOT EXISTS rollup_level ON rollup (level, reporter, period)')
+    
+    @staticmethod
+    def _cells(payload):
+        """Return the WHERE clause and parameters selecting the cells of payload."""
+        clause = ['freq = ?']
+        params = [payload['freq']]
+        for key, column in [('r', 'reporter'), ('p', 'partner'), ('ps', 'period'), ('rg', 'flow')]:
+            codes = str(payload.get(key, 'all'))
+            if codes != 'all':
+                clause.append('{} IN ({})'.format(column, ','.join('?' * len(codes.split(',')))))
+                params.extend(int(x) for x in codes.split(','))
+        return ' AND '.join(clause), params
+    
+    def rollup(self, df):
+        """Sum HS6 records into one DataFrame of HS2, HS4 and total rows."""
+        df = df[(df['Aggregate Level'] == 6) & df['Commodity Code'].notna()]
+        keys = ['Period', 'Trade Flow Code', 'Reporter Code', 'Partner Code']
+        measures = ['Qty', 'Netweight (kg)', 'Trade Value (US$)']
+        parts = []
+        for level, divisor in self.levels.items():
+            if divisor is None:
+                code = pd.Series('TOTAL', index = df.index)
+            else:
+                code = (df['Commodity Code'] // divisor).astype(str).str.zfill(level)
+            grouped = df[keys + measures].assign(code = code).groupby(keys + ['code'], observed = True)
+            part = grouped[measures].sum(min_count = 1)
+            part['records'] = grouped.size()
+            parts.append(part.reset_index().assign(level = level))
+        return pd.concat(parts, ignore_index = True)
+    
+    def write(self, payload, resp):
+        cc = str(payload.get('cc', 'ALL'))
+        if cc.upper() not in ('AG6', 'ALL'):
+            raise ValueError('RollupSink needs whole cells (cc AG6 or ALL), not cc ' + repr(cc) + '.')
+        rows = []
+        if not _no_data(resp.text):
+            cube = self.rollup(parse_records(resp.content))
+            cube = cube.astype(object).where(cube.notna(), None)
+            rows = [(payload['freq'], x['Period'], x['Trade Flow Code'], x['Reporter Code'], x['Partner Code'],
+                     x['level'], x['code'], x['Qty'], x['Netweight (kg)'], x['Trade Value (US$)'], x['records'])
+                    for x in cube.to_dict('records')]
+        clause, params = self._cells(payload)
+        with self.lock, self.db:
+            # An empty answer still clears whatever the cells held before.
+            self.db.execute('DELETE FROM rollup WHERE ' + clause, params)
+            self.db.executemany('INSERT OR REPLACE INTO rollup VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    
+    def query(self, level, freq = 'M', reporters = None, partners = None, periods = None, flows = None):
+        """
+        Return the level 2, 4 or 0 (total) rows for the given codes (None
+        for all) as a DataFrame.
+        """
+        clause = ['level = ?', 'freq = ?']
+        params = [level, freq]
+        for codes, column in [(reporters, 'reporter'), (partners, 'partner'), (periods, 'period'), (flows, 'flow')]:
+            if codes is not None:
+                codes = list(codes)
+                clause.append('{} IN ({})'.format(column, ','.join('?' * len(codes))))
+                params.extend(int(x) for x in codes)
+        with self.lock:
+            return pd.read_sql_query('SELECT period, flow, reporter, partner, code, qty, netweight, value, records '
+                                     'FROM rollup WHERE ' + ' AND '.join(clause) +
+                                     ' ORDER BY period, flow, reporter, partner, code', self.db, params = params)
+    
+    def sync(self):
+        return 0
+    
+    def close(self):
+        self.db.close()
+
+def _checkpointed(sink, checkpoint):
+    """
+    Return a write(payload, resp) callback that writes to sink, if any, and
+    then records the unit as complete in checkpoint.
+    """
+    lock = threading.Lock()
+    def write(payload, resp):
+        with lock:
+            offset = 0
+            if sink is not None:
+                sink.write(payload, resp)
+                offset = sink.sync()
+            checkpoint.complete(payload, _row_count(resp.text), offset)
+    return write
+
+class Checkpoint:
+    """
+    Manifest of a long download, kept in an SQLite file next to its output.
+    It stores the planned query units and, for each completed one, its row
+    count and the size of the output file after it was written, so that an
+    interrupted run can resume without repeating work.
+    """
+    
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, check_same_thread = False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS units (seq INTEGER PRIMARY KEY, key TEXT UNIQUE, '
+                            'payload TEXT, status TEXT, rows INTEGER, offset INTEGER)')
+    
+    @staticmethod
+    def key(payload):
+        return '|'.join(str(payload.get(x, '')) for x in ['r', 'p', 'ps', 'rg', 'cc', 'freq'])
+    
+    def plan(self, payloads):
+        """
+        Record payloads as the plan on the first run and return the units
+        still pending, in planned order.
+        """
+        with self.lock, self.db:
+            if self.db.execute('SELECT COUNT(*) FROM units').fetchone()[0] == 0:
+                self.db.executemany('INSERT INTO units (key, payload, status) VALUES (?, ?, ?)',
+                                    [(self.key(x), json.dumps(x), 'pending') for x in payloads])
+            cursor = self.db.execute("SELECT payload FROM units WHERE status = 'pending' ORDER BY seq")
+            return [json.loads(x) for x, in cursor]
+    
+    def complete(self, payload, rows, offset):
+        with self.lock, self.db:
+            self.db.execute("UPDATE units SET status = 'done', rows = ?, offset = ? WHERE key = ?",
+                            (rows, offset, self.key(payload)))
+    
+    def split(self, payload, parts):
+        """Replace a unit whose result was truncated by its parts."""
+        with self.lock, self.db:
+            self.db.execute("UPDATE units SET status = 'split' WHERE key = ?", (self.key(payload),))
+            self.db.executemany('INSERT OR IGNORE INTO units (key, payload, status) VALUES (?, ?, ?)',
+                                [(self.key(x), json.dumps(x), 'pending') for x in parts])
+    
+    def offset(self):
+        """Return the size of the output file after the last completed unit."""
+        with self.lock:
+            return self.db.execute("SELECT COALESCE(MAX(offset), 0) FROM units WHERE status = 'done'").fetchone()[0]
+    
+    def close(self):
+        self.db.close()
+
+# Query planning. The API takes at most five reporters, five partners and
+# five periods per call and truncates results at max rows, so work is packed
+# against row counts seen in past responses.
+
+max_rows = 50000
+default_row_estimate = 500
+api_limits = {'r': 5, 'p': 5, 'ps': 5}
+
+def _row_count(text):
+    if _no_data(text):
+        return 0
+    return text.count('\n') + (0 if text.endswith('\n') else 1) - 1
+
+class RowEstimates:
+    """
+    Row counts of past responses per (reporter, partner, period) cell,
+    stored in an SQLite file and used to size queries.
+    Cells never seen fall back to the mean of the same reporter-period,
+    then to default_row_estimate.
+    """
+    
+    def __init__(self, filename = None):
+        if filename is None:
+            filename = os.path.join(cache_dir, 'rows.sqlite')
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok = True)
+        self.db = sqlite3.connect(filename, check_same_thread = False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS rows (r TEXT, p TEXT, ps TEXT, rg TEXT, cc TEXT, n INTEGER, '
+                            'PRIMARY KEY (r, p, ps, rg, cc))')
+    
+    def record(self, payload, content):
+        """Store the per-cell row counts of a CSV response body to payload."""
+        counts = dict.fromkeys(itertools.product(payload['r'].split(','),
+                                                 payload['p'].split(','),
+                                                 payload['ps'].split(',')), 0)
+        df = parse_records(content, usecols = ['Reporter Code', 'Partner Code', 'Period'])
+        for (r, p, ps), n in df.groupby(['Reporter Code', 'Partner Code', 'Period']).size().items():
+            counts[(str(r), str(p), str(ps))] = int(n)
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?, ?, ?)',
+                                [(r, p, ps, payload['rg'], payload['cc'], n) for (r, p, ps), n in counts.items()])
+    
+    def load(self, reporters, rg, cc):
+        """Return {(r, p, ps): rows} for the given reporters."""
+        with self.lock:
+            cursor = self.db.execute('SELECT r, p, ps, n FROM rows WHERE rg = ? AND cc = ? AND r IN ({})'.format(
+                ','.join('?' * len(reporters))), [rg, cc] + list(reporters))
+            return {(r, p, ps): n for r, p, ps, n in cursor}
+
+_row_estimates = None
+
+def row_estimates():
+    global _row_estimates
+    if _row_estimates is None:
+        _row_estimates = RowEstimates()
+    return _row_estimates
+
+def _estimator(known):
+    """Return an estimate(reporters, partners, periods) function over known cell counts."""
+    totals = {}
+    for (r, p, ps), n in known.items():
+        total = totals.setdefault((r, ps), [0, 0])
+        total[0] += n
+        total[1] += 1
+    def estimate(reporters, partners, periods):
+        rows = 0
+        for r, ps in itertools.product(reporters, periods):
+            total = totals.get((r, ps))
+            fallback = total[0] / total[1] if total else default_row_estimate
+            rows += sum(known.get((r, p, ps), fallback) for p in partners)
+        return rows
+    return estimate
+
+def plan_queries(reporters, partners, periods, base, estimates = None, fill = 0.8):
+    """
+    Pack reporters, partners and periods into as few query payloads as the
+    API limits allow, keeping the estimated rows of each under
+    max_rows * fill. base holds the remaining query parameters.
+    Return a list of payloads.
+    """
+    if estimates is None:
+        estimates = row_estimates()
+    reporters, partners, periods = [list(map(str, x)) for x in [reporters, partners, periods]]
+    estimate = _estimator(estimates.load(reporters, base['rg'], base['cc']))
+    
+    def pack(unit):
+        if estimate(*unit) <= max_rows * fill or all(len(x) == 1 for x in unit):
+            return [unit]
+        i = max(range(3), key = lambda x: len(unit[x]))
+        half = (len(unit[i]) + 1) // 2
+        return (pack(unit[:i] + (unit[i][:half],) + unit[i + 1:]) +
+                pack(unit[:i] + (unit[i][half:],) + unit[i + 1:]))
+    
+    payloads = []
+    for unit in itertools.product(_chunks(reporters, api_limits['r']),
+                                  _chunks(partners, api_limits['p']),
+                                  _chunks(periods, api_limits['ps'])):
+        for r, p, ps in pack(unit):
+            payload = dict(base, r = ','.join(r), p = ','.join(p), ps = ','.join(ps))
+            payload['max'] = max_rows
+            payloads.append(payload)
+    return payloads
+
+def split_payload(payload):
+    """
+    Split a query along its widest dimension into two queries. A query for
+    a single reporter, partner and period is split instead into four, one
+    per flow, when rg is all, and otherwise into halves of an explicit
+    commodity list.
+    Return None when it cannot be split any further.
+    """
+    key = max(['ps', 'p', 'r'], key = lambda x: len(payload[x].split(',')))
+    codes = payload[key].split(',')
+    if len(codes) == 1:
+        if str(payload.get('rg')) == 'all':
+            return [dict(payload, rg = x) for x in ['1', '2', '3', '4']]
+        key = 'cc'
+        codes = str(payload.get('cc', '')).split(',')
+        if len(codes) == 1:
+            return None
+    half = (len(codes) + 1) // 2
+    return [dict(payload, **{key: ','.join(codes[:half])}),
+            dict(payload, **{key: ','.join(codes[half:])})]
+
+# Pruning. Queries for reporter-periods the availability records show as
+# empty, or for partner codes that do not exist, are dropped or narrowed
+# before they are sent.
+
+def availability_index(periods, freq, offline = False):
+    """
+    Return {period: set of reporters with data} for the given periods.
+    Availability is fetched for periods not checked within their freshness
+    window (see _period_ttl); periods it cannot be had for, or that have
+    no records at all, are left out, meaning unknown. With offline = True
+    only stored records are used.
+    """
+    store = availability_store()
+    for period in map(str, periods):
+        if offline:
+            break
+        checked = store.checked(period, freq)
+        ttl = _period_ttl(period)
+        if checked is None or (ttl is not None and time() - checked > ttl):
+            try:
+                store.update(get_availability(period, freq), period, freq)
+            except (ComtradeError, requests.RequestException, ValueError):
+                continue
+    available = store.available(periods, freq)
+    listed = {ps for r, ps in available}
+    index = {str(x): set() for x in periods if str(x) in listed and store.checked(x, freq) is not None}
+    for (r, ps), total in available.items():
+        if total != 0 and ps in index:
+            index[ps].add(r)
+    return index
+
+def _narrow(reporters, partners, periods, index, valid_partners):
+    """Narrow the codes of one query unit to those that can return data."""
+    if valid_partners is not None and partners != ['all']:
+        partners = [x for x in partners if x in valid_partners]
+    unknown = any(x not in index for x in periods)
+    if reporters != ['all']:
+        reporters = [x for x in reporters if unknown or any(x in index[y] for y in periods)]
+    periods = [x for x in periods if x not in index or
+               (index[x] if reporters == ['all'] else index[x].intersection(reporters))]
+    return reporters, partners, periods
+
+def prune_queries(payloads, index, valid_partners = None):
+    """
+    Drop or narrow query payloads against an availability_index and a set
+    of valid partner codes. Return the payloads that can still return data.
+    """
+    pruned = []
+    for payload in payloads:
+        r, p, ps = _narrow(payload['r'].split(','), payload['p'].split(','), payload['ps'].split(','),
+                           index, valid_partners)
+        if r and p and ps:
+            pruned.append(dict(payload, r = ','.join(r), p = ','.join(p), ps = ','.join(ps)))
+    if payloads and not pruned:
+        print('Warning: pruning dropped all ' + str(len(payloads)) + ' queries against the availability records.')
+    elif len(pruned) < len(payloads):
+        print('Pruned ' + str(len(payloads) - len(pruned)) + ' of ' + str(len(payloads)) +
+            ' queries that cannot return data.')
+    return pruned
+
+async def fetch_async(payloads, concurrency = None, write = None, estimates = None, checkpoint = None,
+                      refresh = False, progress = None, process = None):
+    """
+    Send query payloads with at most concurrency requests in flight and
+    yield (payload, response) pairs in completion order.
+    If write is given, write(payload, response) is run in a worker thread
+    before the pair is yielded. A response that comes back at the row cap is
+    split into two smaller queries which are sent in its place.
+    Row counts are recorded in estimates (row_estimates() by default) and
+    splits in checkpoint and progress, if given. With refresh, cached
+    answers are not used. concurrency defaults to the module setting at
+    call time. If process is given, process(payload, response) is run in
+    the worker thread as well and its result is yielded in place of the
+    response. If checkpoint has a fail(payload, error) method, a unit whose
+    request fails for good is handed to it and skipped instead of ending
+    the crawl.
+    """
+    if concurrency is None:
+        concurrency = globals()['concurrency']
+    if estimates is None:
+        estimates = row_estimates()
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers = concurrency * 2)
+    fail = getattr(checkpoint, 'fail', None)
+    
+    def receive(payload):
         try:
-            resp = requests.get(url + urllib.parse.urlencode(payload))
-            if resp.text != '{"Message":"An error has occurred."}' and resp.text != 'RATE LIMIT: You must wait 1 seconds.':
-                break
-        except:
-            sleep(1)
-        else:
-            if resp.text == '{"Message":"An error has occurred."}':
-                print('An error has occurred with message:\n' + resp.text)
-                sleep(600)
-            if resp.text == 'RATE LIMIT: You must wait 1 seconds.':
-                print('An error has occurred with message:\n' + resp.text)
-                sleep(5)
-    if resp.text.split(sep = '\r\n')[1] == 'No data matches your query or your query is too complex. Request JSON or XML format for more information.,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,':
-        print('No data matches for ' + country_group + '.')
-        return()
-    data = resp.text
-    if counter != 0:
-        with_header = data.split(sep = '\r\n')
-        header_removed = [with_header[x] for x in range(len(with_header)) if x != 0]
-        data = '\r\n'.join(header_removed)
-    file.write(data)
-    print('Data for ' + country_group + ' written on ' + 
-        strftime("%Y-%m-%d %H:%M:%S") + '.')
+            resp = _request(payload, refresh)
+        except ComtradeError as e:
+            # A bad token fails every unit alike; that one still ends the crawl.
+            if fail is None or isinstance(e, AuthenticationError):
+                raise
+            print('Unit for ' + _describe(payload) + ' failed: ' + type(e).__name__ + ': ' + str(e))
+            fail(payload, e)
+            if progress is not None:
+                progress.add(-1)
+            metrics.count('failed_units')
+            metrics.event('failed', r = payload['r'], p = payload['p'], ps = payload['ps'],
+                          error = type(e).__name__, message = str(e))
+            return None, []
+        if isinstance(classify(resp, payload), TruncatedResultError):
+            parts = split_payload(payload)
+            if parts is not None:
+                print('Result for ' + payload['r'] + ', partners ' + payload['p'] + ', periods ' +
+                    payload['ps'] + ' truncated, splitting.')
+                if checkpoint is not None:
+                    checkpoint.split(payload, parts)
+                if progress is not None:
+                    progress.add(len(parts) - 1)
+                metrics.count('splits')
+                return resp, parts
+            # Nothing left to split on: keep what came back, but say so.
+            print('Warning: result for ' + _describe(payload) + ' is still truncated at ' +
+                  str(payload.get('max', max_rows)) + ' rows and cannot be split further; '
+                  'it is kept incomplete.')
+            metrics.count('truncated_kept')
+            metrics.event('truncated', r = payload['r'], p = payload['p'], ps = payload['ps'],
+                          rg = payload.get('rg'), cc = payload.get('cc'))
+        estimates.record(payload, resp.content)
+        if write is not None:
+            write(payload, resp)
+        if process is not None:
+            return process(payload, resp), None
+        return resp, None
+    
+    async def run(payload):
+        resp, parts = await loop.run_in_executor(executor, receive, payload)
+        return payload, resp, parts
+    
+    payloads = iter(payloads)
+    retries = collections.deque()
+    pending = set()
+    try:
+        while True:
+            while retries and len(pending) < concurrency:
+                pending.add(asyncio.ensure_future(run(retries.popleft())))
+            if len(pending) < concurrency:
+                for payload in payloads:
+                    pending.add(asyncio.ensure_future(run(payload)))
+                    if len(pending) >= concurrency:
+                        break
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when = asyncio.FIRST_COMPLETED)
+            for task in done:
+                payload, resp, parts = task.result()
+                if parts is not None:
+                    retries.extend(parts)
+                    continue
+                yield payload, resp
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions = True)
+        # Let requests already sent finish their writes before returning, so
+        # nothing is written behind the caller's back.
+        executor.shutdown(wait = True, cancel_futures = True)
+
+def fetch_batch(payloads, concurrency = None, write = None, estimates = None, checkpoint = None,
+                refresh = False, progress = None, process = None):
+    """
+    Synchronous wrapper around fetch_async.
+    Yield (payload, response) pairs in completion order.
+    """
+    loop = asyncio.new_event_loop()
+    results = fetch_async(payloads, concurrency, write, estimates, checkpoint, refresh, progress, process)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(results.aclose())
+        loop.close()
+
+
+# Generic query API. fetch() is the one path every download goes through;
+# the get_* functions below are presets of it.
+
+class TeeSink:
+    """
+    Hand every response to several sinks. sync() syncs them all and
+    reports the offset of synced, the first sink by default.
+    """
+    
+    def __init__(self, *sinks, synced = None):
+        self.sinks = sinks
+        self.synced = sinks[0] if synced is None else synced
+    
+    def write(self, payload, resp):
+        for sink in self.sinks:
+            sink.write(payload, resp)
+    
+    def sync(self):
+        offsets = {sink: sink.sync() for sink in self.sinks}
+        return offsets[self.synced]
+    
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+def _describe(payload):
+    return 'reporters ' + payload['r'] + ', partners ' + payload['p'] + ', periods ' + payload['ps']
+
+def _fetch_payloads(payloads, sink = None, checkpoint = None, refresh = False, plan = True, parse = True):
+    """
+    Send planned payloads through the fetch engine, hand each response to
+    sink and yield its parsed records, parsed in the worker threads; with
+    parse = False nothing is parsed and the responses are yielded as they
+    are. With a checkpoint, only pending units are sent (unless plan is
+    False, when payloads are already the units to send) and each one is
+    recorded once written.
+    Progress is printed with each unit when show_progress is set.
+    """
+    if checkpoint is not None:
+        if plan:
+            payloads = checkpoint.plan(payloads)
+        write = _checkpointed(sink, checkpoint)
+    else:
+        write = sink.write if sink is not None else None
+    
+    def process(payload, resp):
+        if _no_data(resp.text):
+            return resp, None, 0
+        if parse:
+            records = parse_records(resp.content)
+            return resp, records, len(records)
+        return resp, None, _row_count(resp.text)
+    
+    progress = Progress(len(payloads) if hasattr(payloads, '__len__') else None)
+    metrics.event('plan', units = progress.total)
+    for payload, (resp, records, rows) in fetch_batch(payloads, write = write, checkpoint = checkpoint,
+                                                      refresh = refresh, progress = progress,
+                                                      process = process):
+        progress.update(rows)
+        metrics.count('rows', rows)
+        metrics.observe('rows_per_unit', rows)
+        metrics.event('unit', r = payload['r'], p = payload['p'], ps = payload['ps'], rows = rows)
+        suffix = ' [' + str(progress) + ']' if show_progress else ''
+        if rows == 0:
+            print('No data matches for ' + _describe(payload) + '.' + suffix)
+            continue
+        print('Data for ' + _describe(payload) + ' written on ' +
+            strftime("%Y-%m-%d %H:%M:%S") + '.' + suffix)
+        yield records if parse else resp
+
+def fetch(reporters, partners, periods, flows = '1', commodity = 'AG6', freq = 'M', sink = None,
+          checkpoint = None, refresh = False, prune = True, parse = True):
+    """
+    Retrieve trade data for every combination of reporters, partners and
+    periods (lists of codes; YYYY or YYYYMM periods according to freq).
+    flows is the rg parameter (1 imports, 2 exports) and commodity the cc
+    parameter. Queries are packed by plan_queries and sent concurrently;
+    each response is handed to sink, if given, and its records are yielded
+    as DataFrames typed after record_schema, in completion order (with
+    parse = False, the raw responses instead). With prune, reporter-periods without data according to the
+    availability records and unknown partner codes are left out.
+    """
+    reporters, partners, periods = [list(map(str, x)) for x in [reporters, partners, periods]]
+    base = {'type': 'C',
+            'freq': freq,
+            'px': 'HS',
+            'rg': str(flows),
+            'cc': commodity,
+            'fmt': 'csv'
+    }
+    payloads = _plan(reporters, partners, periods, base, prune)
+    yield from _fetch_payloads(payloads, sink, checkpoint, refresh, parse = parse)
+
+def _plan(reporters, partners, periods, base, prune = True, offline = False):
+    """Plan the query units of a fetch, pruned with the availability records if prune is set."""
+    if not prune:
+        return plan_queries(reporters, partners, periods, base)
+    index = availability_index(periods, base['freq'], offline)
+    valid_partners = set(get_partners()[1]) | {'0'}
+    reporters, partners, periods = _narrow(reporters, partners, periods, index, valid_partners)
+    return prune_queries(plan_queries(reporters, partners, periods, base), index, valid_partners)
+
+def _run(batches):
+    for _ in batches:
+        pass
+
+def get_taiwan(year, month, sink = None):
+    """
+    Retrieve import data of all reporting countries where Taiwan is
+    partner country.
+    One file per month, loop over all reporting countries.
+    Results go to sink, a CsvSink on the monthly file by default.
+    """
+    reporter_list = get_reporters()[0]
+    
+    if sink is None:
+        sink = CsvSink(str(year) + '-' + str(month).zfill(2) + '.csv')
+    _run(fetch(reporter_list, ['490'], [str(year) + str(month).zfill(2)], sink = sink, parse = False))
+    sink.close()
     
     print('\nData for ' + calendar.month_name[month] + ', ' + str(year) +
         ' written on ' + strftime("%Y-%m-%d %H:%M:%S") + '.\n')
-    file.close()
     return()
 
 def get_taiwan_all():
@@ -199,361 +1934,696 @@ def get_taiwan_all():
     return()
 
 
-def get_taiwan_annual(year):
+def get_taiwan_annual(year, sink = None):
     """
     Retrieve import data of all reporting countries where Taiwan is
     partner country.
     Loop over all reporting countries.
+    Results go to sink, a CsvSink on the yearly file by default.
     """
-
-    filename = str(year) + '.csv'
-    file = open(filename, encoding = 'utf-8', mode = 'w', newline = '')
-    
-    # Iteration part
-    counter = 0
-    for i in reporter_list:
-        # country_group = ','.join(reporter_list[i : i + 5])
-        payload = {'max': 50000,
-                   'type': 'C',
-                   'freq': 'A',
-                   'px': 'HS',
-                   'ps': str(year),
-                   'r': str(i),
-                   'p': '490',
-                   'rg': '1',
-                   'cc': 'AG6',
-                   'fmt': 'csv'
-        }
-        while True:
-            try:
-                resp = requests.get(url + urllib.parse.urlencode(payload))
-                if resp.text != '{"Message":"An error has occurred."}' and resp.text != 'RATE LIMIT: You must wait 1 seconds.':
-                    break
-            except:
-                sleep(1)
-            else:
-                if resp.text == '{"Message":"An error has occurred."}':
-                    print('An error has occurred with message:\n' + resp.text)
-                    sleep(37)
-                    continue
-                if resp.text == 'RATE LIMIT: You must wait 1 seconds.':
-                    print('An error has occurred with message:\n' + resp.text)
-                    sleep(5)
-        if resp.text.split(sep = '\r\n')[1] == 'No data matches your query or your query is too complex. Request JSON or XML format for more information.,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,':
-            print('No data matches for ' + str(i) + '.')
-            sleep(37)
-            continue
-        data = resp.text
-        if counter != 0:
-            with_header = data.split(sep = '\r\n')
-            header_removed = [with_header[x] for x in range(len(with_header)) if x != 0]
-            data = '\r\n'.join(header_removed)
-        file.write(data)
-        print('Data for ' + str(i) + ' written on ' + 
-            strftime("%Y-%m-%d %H:%M:%S") + '.')
-        counter += 1
-        sleep(37)
-    
-    # Last iteration
-    # country_group = ','.join(reporter_list[len(reporter_list) // 5 * 5 : len(reporter_list)])
-    # payload = {'max': 50000,
-               # 'type': 'C',
-               # 'freq': 'A',
-               # 'px': 'HS',
-               # 'ps': str(year),
-               # 'r': country_group,
-               # 'p': '490',
-               # 'rg': '1',
-               # 'cc': 'AG6',
-               # 'fmt': 'csv'
-    # }
-    # while True:
-        # try:
-            # resp = requests.get(url + urllib.parse.urlencode(payload))
-            # if resp.text != '{"Message":"An error has occurred."}' and resp.text != 'RATE LIMIT: You must wait 1 seconds.':
-                # break
-        # except:
-            # sleep(1)
-        # else:
-            # if resp.text == '{"Message":"An error has occurred."}':
-                # print('An error has occurred with message:\n' + resp.text)
-                # sleep(600)
-            # if resp.text == 'RATE LIMIT: You must wait 1 seconds.':
-                # print('An error has occurred with message:\n' + resp.text)
-                # sleep(5)
-    # if resp.text.split(sep = '\r\n')[1] == 'No data matches your query or your query is too complex. Request JSON or XML format for more information.,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,':
-        # print('No data matches for ' + country_group + '.')
-        # return()
-    # data = resp.text
-    # if counter != 0:
-        # with_header = data.split(sep = '\r\n')
-        # header_removed = [with_header[x] for x in range(len(with_header)) if x != 0]
-        # data = '\r\n'.join(header_removed)
-    # file.write(data)
-    # print('Data for ' + country_group + ' written on ' + 
-        # strftime("%Y-%m-%d %H:%M:%S") + '.')
+    reporter_list = get_reporters()[0]
     
-    print('\nData for ' + calendar.month_name[month] + ', ' + str(year) +
-        ' written on ' + strftime("%Y-%m-%d %H:%M:%S") + '.\n')
-    file.close()
+    if sink is None:
+        sink = CsvSink(str(year) + '.csv')
+    _run(fetch(reporter_list, ['490'], [str(year)], freq = 'A', sink = sink, parse = False))
+    sink.close()
+    
+    print('\nData for ' + str(year) + ' written on ' + strftime("%Y-%m-%d %H:%M:%S") + '.\n')
     return()
 
 def get_taiwan_annual_all():
     for year in [2016]:
-        get_taiwan(year)
+        get_taiwan_annual(year)
     return()
 
 
-def get_import(reporter_id):
+def get_import(reporter_id, sink = None):
     """
     Retrieve import data of one single reporting country from all partner countries.
     Loop over all time periods and all partner countries.
+    Results go to sink, a CsvSink on the reporter's file by default.
     """
+    reporter_dict = get_reporters()[1]
+    partner_list = get_partners()[0]
     
     filename = reporter_dict[reporter_id].replace(' ', '_').lower() + '.csv'
-    file = open(filename, encoding = 'utf-8', mode = 'w', newline = '')
     periods = [str(year) + str(month).zfill(2) for year in range(2010, 2016) for month in range(1, 13)]
     periods.extend(['2016' + str(month).zfill(2) for month in range(1, 5)])
-	
-    # Outer iteration part
-    counter = 0
-    for i in range(0, len(periods) // 3 * 3 - 3 + 1, 3):
-        period_group = ','.join(periods[i : i + 3])
-        # Inner iteration part, of outer iteration part
-        for j in range(0, len(partner_list) // 5 * 5 - 5 + 1, 5):
-            partner_group = ','.join(partner_list[j : j + 5])
-            payload = {'max': 50000,
-                       'type': 'C',
-                       'freq': 'M',
-                       'px': 'HS',
-                       'ps': period_group,
-                       'r': reporter_id,
-                       'p': partner_group,
-                       'rg': '1',
-                       'cc': 'AG6',
-                       'fmt': 'csv'
-            }
-            while True:
-                try:
-                    resp = requests.get(url + urllib.parse.urlencode(payload))
-                    if resp.text != '{"Message":"An error has occurred."}' and resp.text != 'RATE LIMIT: You must wait 1 seconds.':
-                        break
-                except:
-                    sleep(1)
-                else:
-                    if resp.text == '{"Message":"An error has occurred."}':
-                        print('An error has occurred with message:\n' + resp.text)
-                        sleep(600)
-                    if resp.text == 'RATE LIMIT: You must wait 1 seconds.':
-                        print('An error has occurred with message:\n' + resp.text)
-                        sleep(5)
-            if resp.text.split(sep = '\r\n')[1] == 'No data matches your query or your query is too complex. Request JSON or XML format for more information.,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,':
-                print('No data matches for ' + period_group + ', partners ' + partner_group + '.')
-                sleep(37)
-                continue
-            data = resp.text
-            if counter != 0:
-                with_header = data.split(sep = '\r\n')
-                header_removed = [with_header[x] for x in range(len(with_header)) if x != 0]
-                data = '\r\n'.join(header_removed)
-            file.write(data)
-            print('Data for ' + period_group + ', partners ' + partner_group + ' written on ' + 
-                strftime("%Y-%m-%d %H:%M:%S") + '.')
-            counter += 1
-            sleep(37)
-
-        # Last inner iteration, of outer iteration part
-        partner_group = ','.join(partner_list[len(partner_list) // 5 * 5 : len(partner_list)])
-        payload = {'max': 50000,
-                   'type': 'C',
-                   'freq': 'M',
-                   'px': 'HS',
-                   'ps': period_group,
-                   'r': reporter_id,
-                   'p': partner_group,
-                   'rg': '1',
-                   'cc': 'AG6',
-                   'fmt': 'csv'
-        }
-        while True:
-            try:
-                resp = requests.get(url + urllib.parse.urlencode(payload))
-                if resp.text != '{"Message":"An error has occurred."}' and resp.text != 'RATE LIMIT: You must wait 1 seconds.':
-                    break
-            except:
-                sleep(1)
-            else:
-                if resp.text == '{"Message":"An error has occurred."}':
-                    print('An error has occurred with message:\n' + resp.text)
-                    sleep(600)
-                if resp.text == 'RATE LIMIT: You must wait 1 seconds.':
-                    print('An error has occurred with message:\n' + resp.text)
-                    sleep(5)
-        if resp.text.split(sep = '\r\n')[1] == 'No data matches your query or your query is too complex. Request JSON or XML format for more information.,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,':
-            print('No data matches for ' + period_group + ', partners ' + partner_group + '.')
-            return()
-        data = resp.text
-        if counter != 0:
-            with_header = data.split(sep = '\r\n')
-            header_removed = [with_header[x] for x in range(len(with_header)) if x != 0]
-            data = '\r\n'.join(header_removed)
-        file.write(data)
-        print('Data for ' + period_group + ', partners ' + partner_group + ' written on ' + 
-            strftime("%Y-%m-%d %H:%M:%S") + '.')
-        
-        print('Data for ' + period_group + ' for ALL PARTNERS written on ' +
-            strftime("%Y-%m-%d %H:%M:%S") + '.')
-
-    # Last outer iteration
-    period_group = ','.join(periods[len(periods) // 3 * 3 : len(periods)])
-    # Inner iteration part, of last outer iteration
-    for j in range(0, len(partner_list) // 5 * 5 - 5 + 1, 5):
-        partner_group = ','.join(partner_list[j : j + 5])
-        payload = {'max': 50000,
-                   'type': 'C',
-                   'freq': 'M',
-                   'px': 'HS',
-                   'ps': period_group,
-                   'r': reporter_id,
-                   'p': partner_group,
-                   'rg': '1',
-                   'cc': 'AG6',
-                   'fmt': 'csv'
-        }
-        while True:
-            try:
-                resp = requests.get(url + urllib.parse.urlencode(payload))
-                if resp.text != '{"Message":"An error has occurred."}' and resp.text != 'RATE LIMIT: You must wait 1 seconds.':
-                    break
-            except:
-                sleep(1)
-            else:
-                if resp.text == '{"Message":"An error has occurred."}':
-                    print('An error has occurred with message:\n' + resp.text)
-                    sleep(600)
-                if resp.text == 'RATE LIMIT: You must wait 1 seconds.':
-                    print('An error has occurred with message:\n' + resp.text)
-                    sleep(5)
-        if resp.text.split(sep = '\r\n')[1] == 'No data matches your query or your query is too complex. Request JSON or XML format for more information.,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,':
-            print('No data matches for ' + period_group + ', partners ' + partner_group + '.')
-            sleep(37)
-            continue
-        data = resp.text
-        if counter != 0:
-            with_header = data.split(sep = '\r\n')
-            header_removed = [with_header[x] for x in range(len(with_header)) if x != 0]
-            data = '\r\n'.join(header_removed)
-        file.write(data)
-        print('Data for ' + period_group + ', partners ' + partner_group + ' written on ' + 
-            strftime("%Y-%m-%d %H:%M:%S") + '.')
-        counter += 1
-        sleep(37)
-
-    # Last inner iteration, of last outer iteration
-    partner_group = ','.join(partner_list[len(partner_list) // 5 * 5 : len(partner_list)])
-    payload = {'max': 50000,
-               'type': 'C',
-               'freq': 'M',
-               'px': 'HS',
-               'ps': period_group,
-               'r': reporter_id,
-               'p': partner_group,
-               'rg': '1',
-               'cc': 'AG6',
-               'fmt': 'csv'
-    }
-    while True:
-        try:
-            resp = requests.get(url + urllib.parse.urlencode(payload))
-            if resp.text != '{"Message":"An error has occurred."}' and resp.text != 'RATE LIMIT: You must wait 1 seconds.':
-                break
-        except:
-            sleep(1)
-        else:
-            if resp.text == '{"Message":"An error has occurred."}':
-                print('An error has occurred with message:\n' + resp.text)
-                sleep(600)
-            if resp.text == 'RATE LIMIT: You must wait 1 seconds.':
-                print('An error has occurred with message:\n' + resp.text)
-                sleep(5)
-    if resp.text.split(sep = '\r\n')[1] == 'No data matches your query or your query is too complex. Request JSON or XML format for more information.,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,':
-        print('No data matches for ' + period_group + ', partners ' + partner_group + '.')
-        return()
-    data = resp.text
-    if counter != 0:
-        with_header = data.split(sep = '\r\n')
-        header_removed = [with_header[x] for x in range(len(with_header)) if x != 0]
-        data = '\r\n'.join(header_removed)
-    file.write(data)
-    print('Data for ' + period_group + ', partners ' + partner_group + ' written on ' + 
-        strftime("%Y-%m-%d %H:%M:%S") + '.')
-    
-    print('Data for ' + period_group + ' for ALL PARTNERS written on ' + 
-        strftime("%Y-%m-%d %H:%M:%S") + '.')
+    
+    # Progress is kept in a checkpoint next to the output file; a restarted
+    # run drops anything written after the last completed unit and only
+    # sends the units still pending. Delete both files to start over.
+    checkpoint = Checkpoint(filename + '.checkpoint')
+    if sink is None:
+        sink = CsvSink(filename, offset = checkpoint.offset())
+    _run(fetch([reporter_id], partner_list, periods, sink = sink, checkpoint = checkpoint, parse = False))
+    sink.close()
+    checkpoint.close()
     
     print('\nData for ' + reporter_dict[reporter_id].replace(' ', '_').lower() +
         ' written on ' + strftime("%Y-%m-%d %H:%M:%S") + '.\n')
-    file.close()
     return()
 
 def find_key(input_dict, value):
+    for reference in _reference.values():
+        if reference['dict'] is input_dict:
+            return(reference['reverse'].get(value))
     return(next((k for k, v in input_dict.items() if v == value), None))
 
 def get_import_selected():
+    reporter_dict = get_reporters()[1]
     for reporter_id in [find_key(reporter_dict, x) for x in ['China', 'Indonesia', 'India', 'Viet Nam', 'Turkey', 'USA']]:
         get_import(reporter_id)
 
 def get_import_all():
+    reporter_dict = get_reporters()[1]
     for reporter_id in reporter_dict:
         get_import(reporter_id)
 
 
-def get_import_from_world(reporter_id):
+def get_import_from_world(reporter_id, sink = None):
     """
     Retrieve import data of one single reporting country from the world.
-    Loop over 2014, 2015 (annually) and all partner countries.
+    Loop over 2012, 2013 (annually).
+    Results go to sink, a CsvSink on the reporter's file by default.
     """
+    reporter_dict = get_reporters()[1]
     filename = reporter_dict[reporter_id].replace(' ', '_').lower() + '.csv'
-    if os.path.isfile(filename) == True:
-        return()
-    payload = {'max': 50000,
-               'type': 'C',
-               'freq': 'A',
-               'px': 'HS',
-               'ps': '2012,2013',
-               'r': reporter_id,
-               'p': '0',
-               'rg': '1',
-               'cc': 'AG6',
-               'fmt': 'csv'
-    }
-    while True:
-        try:
-            resp = requests.get(url + urllib.parse.urlencode(payload))
-            if resp.text != '{"Message":"An error has occurred."}' and resp.text != 'RATE LIMIT: You must wait 1 seconds.':
-                break
-        except:
-            sleep(1)
-        else:
-            if resp.text == '{"Message":"An error has occurred."}':
-                print('An error has occurred with message:\n' + resp.text)
-                sleep(600)
-            if resp.text == 'RATE LIMIT: You must wait 1 seconds.':
-                print('An error has occurred with message:\n' + resp.text)
-                sleep(5)
-                
-    if resp.text.split(sep = '\r\n')[1] == 'No data matches your query or your query is too complex. Request JSON or XML format for more information.,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,':
-        print('No data matches for ' + reporter_dict[reporter_id].replace(' ', '_').lower())
-        sleep(37)
-        return()
-    data = resp.text
-    filename = reporter_dict[reporter_id].replace(' ', '_').lower() + '.csv'
-    with open(filename, encoding = 'utf-8', mode = 'w', newline = '') as file:
-        file.write(data)
+    if sink is None:
+        if os.path.isfile(filename) == True:
+            return()
+        sink = CsvSink(filename)
+    _run(fetch([reporter_id], ['0'], ['2012', '2013'], freq = 'A', sink = sink, parse = False))
+    sink.close()
+    
     print('\nData for ' + reporter_dict[reporter_id].replace(' ', '_').lower() +
         ' written on ' + strftime("%Y-%m-%d %H:%M:%S") + '.\n')
     return()
 
 def get_import_from_world_all():
+    reporter_dict = get_reporters()[1]
     for reporter_id in reporter_dict:
-        get_import_from_world(reporter_id)
\ No newline at end of file
+        get_import_from_world(reporter_id)
+
+
+# Distributed crawls. A WorkQueue file on a shared filesystem holds the
+# query units of a crawl; any number of run_worker processes, on any number
+# of machines, lease units from it and write their results as per-unit
+# files, which merge_queue joins into one output once the crawl is done.
+
+class WorkQueue:
+    """
+    Lease-based queue of query units in an SQLite file.
+    A worker claims a pending unit for lease seconds, keeps the lease alive
+    with heartbeat() and marks the unit done with complete(). Units whose
+    lease expired, because their worker died, are handed out again, up to
+    max_attempts claims; a unit that fails with a ClientError, or after
+    max_attempts claims, is marked failed with its error and left alone.
+    It offers the Checkpoint interface (complete, split, fail) to the
+    fetch engine, on behalf of owner.
+    """
+    
+    def __init__(self, filename, owner = None, lease = 600, max_attempts = 3):
+        self.owner = owner or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.db = sqlite3.connect(filename, timeout = 60, isolation_level = None, check_same_thread = False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute('CREATE TABLE IF NOT EXISTS units (seq INTEGER PRIMARY KEY, key TEXT UNIQUE, '
+                            'payload TEXT, status TEXT, owner TEXT, expires REAL, attempts INTEGER DEFAULT 0, '
+                            'rows INTEGER, error TEXT)')
+            # Queues created before failed units were recorded.
+            if 'error' not in [x[1] for x in self.db.execute('PRAGMA table_info(units)')]:
+                self.db.execute('ALTER TABLE units ADD COLUMN error TEXT')
+    
+    def _transaction(self, statements):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements()
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            return result
+    
+    def add(self, payloads):
+        """Add query units; units already in the queue are left as they are."""
+        self._transaction(lambda: self.db.executemany(
+            "INSERT OR IGNORE INTO units (key, payload, status) VALUES (?, ?, 'pending')",
+            [(Checkpoint.key(x), json.dumps(x)) for x in payloads]))
+    
+    def claim(self):
+        """Lease the next available unit and return its payload, or None."""
+        def claim():
+            now = time()
+            # A unit whose lease ran out max_attempts times keeps killing its workers.
+            self.db.execute("UPDATE units SET status = 'failed', error = 'Lease expired ' || attempts || ' times.' "
+                            "WHERE status = 'leased' AND expires < ? AND attempts >= ?", (now, self.max_attempts))
+            unit = self.db.execute("SELECT seq, payload FROM units WHERE status = 'pending' OR "
+                                   "(status = 'leased' AND expires < ?) ORDER BY seq LIMIT 1", (now,)).fetchone()
+            if unit is None:
+                return None
+            self.db.execute("UPDATE units SET status = 'leased', owner = ?, expires = ?, attempts = attempts + 1 "
+                            "WHERE seq = ?", (self.owner, now + self.lease, unit[0]))
+            return json.loads(unit[1])
+        return self._transaction(claim)
+    
+    def heartbeat(self):
+        """Extend the leases of every unit held by owner."""
+        self._transaction(lambda: self.db.execute(
+            "UPDATE units SET expires = ? WHERE status = 'leased' AND owner = ?",
+            (time() + self.lease, self.owner)))
+    
+    def complete(self, payload, rows, offset = None):
+        self._transaction(lambda: self.db.execute(
+            "UPDATE units SET status = 'done', rows = ? WHERE key = ? AND status != 'split'",
+            (rows, Checkpoint.key(payload))))
+    
+    def split(self, payload, parts):
+        """Replace a truncated unit by its parts, leased to owner."""
+        def split():
+            self.db.execute("UPDATE units SET status = 'split' WHERE key = ?", (Checkpoint.key(payload),))
+            self.db.executemany("INSERT OR IGNORE INTO units (key, payload, status, owner, expires) "
+                                "VALUES (?, ?, 'leased', ?, ?)",
+                                [(Checkpoint.key(x), json.dumps(x), self.owner, time() + self.lease) for x in parts])
+        self._transaction(split)
+    
+    def fail(self, payload, error):
+        """
+        Record that a unit raised error: it is failed for good on a
+        ClientError or once claimed max_attempts times, and otherwise put
+        back to pending.
+        """
+        def fail():
+            key = Checkpoint.key(payload)
+            unit = self.db.execute('SELECT attempts FROM units WHERE key = ?', (key,)).fetchone()
+            final = isinstance(error, ClientError) or unit is None or unit[0] >= self.max_attempts
+            self.db.execute('UPDATE units SET status = ?, owner = NULL, expires = NULL, error = ? WHERE key = ?',
+                            ('failed' if final else 'pending', type(error).__name__ + ': ' + str(error), key))
+        self._transaction(fail)
+    
+    def failed(self):
+        """Return (payload, error) for every failed unit, in queue order."""
+        with self.lock:
+            cursor = self.db.execute("SELECT payload, error FROM units WHERE status = 'failed' ORDER BY seq")
+            return [(json.loads(x), error) for x, error in cursor]
+    
+    def counts(self):
+        """Return the number of units per status."""
+        with self.lock:
+            return dict(self.db.execute('SELECT status, COUNT(*) FROM units GROUP BY status').fetchall())
+    
+    def done(self):
+        """Return the payloads of completed units, in queue order."""
+        with self.lock:
+            cursor = self.db.execute("SELECT payload FROM units WHERE status = 'done' ORDER BY seq")
+            return [json.loads(x) for x, in cursor]
+    
+    def close(self):
+        self.db.close()
+
+def queue_import_all(filename):
+    """
+    Fill a work queue with the units of get_import for every reporter.
+    """
+    partner_list = get_partners()[0]
+    periods = [str(year) + str(month).zfill(2) for year in range(2010, 2016) for month in range(1, 13)]
+    periods.extend(['2016' + str(month).zfill(2) for month in range(1, 5)])
+    base = {'type': 'C',
+            'freq': 'M',
+            'px': 'HS',
+            'rg': '1',
+            'cc': 'AG6',
+            'fmt': 'csv'
+    }
+    queue = WorkQueue(filename)
+    for reporter_id in get_reporters()[0]:
+        queue.add(plan_queries([reporter_id], partner_list, periods, base))
+    print('Queued ' + str(sum(queue.counts().values())) + ' units in ' + filename + '.')
+    queue.close()
+    return()
+
+def run_worker(filename, directory, owner = None, lease = 600, max_attempts = 3):
+    """
+    Work through the queue in filename until no unit is left to claim,
+    writing each unit's result to directory with a CsvPartSink. Leases
+    are renewed in the background while the worker runs. Units that fail
+    are recorded in the queue (see WorkQueue.fail) and the worker goes on.
+    """
+    queue = WorkQueue(filename, owner, lease, max_attempts)
+    stop = threading.Event()
+    def heartbeat():
+        while not stop.wait(lease / 3):
+            queue.heartbeat()
+    thread = threading.Thread(target = heartbeat, daemon = True)
+    thread.start()
+    try:
+        payloads = iter(queue.claim, None)
+        _run(_fetch_payloads(payloads, CsvPartSink(directory), checkpoint = queue, plan = False, parse = False))
+    finally:
+        stop.set()
+        thread.join()
+        print('Worker ' + queue.owner + ' finished: ' + str(queue.counts()) + '.')
+        queue.close()
+    return()
+
+def merge_queue(filename, directory, output):
+    """
+    Join the per-unit results of a finished crawl into one CSV file with a
+    single header, in queue order.
+    """
+    queue = WorkQueue(filename)
+    counts = queue.counts()
+    if counts.get('pending') or counts.get('leased'):
+        print('Crawl not finished yet: ' + str(counts) + '.')
+    for payload, error in queue.failed():
+        print('Unit for ' + _describe(payload) + ' failed and is missing: ' + error)
+    sink = CsvSink(output)
+    for payload in queue.done():
+        path = os.path.join(directory, CsvPartSink.name(payload))
+        if os.path.isfile(path):
+            with open(path, mode = 'rb') as file:
+                sink.write(payload, CachedResponse(file.read()))
+    sink.close()
+    queue.close()
+    return()
+
+
+def refresh(periods, freq = 'M', sink = None):
+    """
+    Incremental update of import data from all partner countries.
+    Availability records for the given periods are fetched and compared with
+    the last refresh; only reporter-periods that are new or were revised
+    since are downloaded, bypassing the response cache.
+    Results go to sink, a CsvSink on refresh-YYYYMMDD.csv by default.
+    """
+    store = availability_store()
+    for period in periods:
+        store.update(get_availability(period, freq), period, freq)
+    changed = store.changed(periods, freq)
+    if not changed:
+        print('No new or revised data for ' + ','.join(map(str, periods)) + '.')
+        return()
+    
+    base = {'type': 'C',
+            'freq': freq,
+            'px': 'HS',
+            'rg': '1',
+            'cc': 'AG6',
+            'fmt': 'csv'
+    }
+    partner_list = get_partners()[0]
+    payloads = []
+    for reporter_id, group in itertools.groupby(changed, key = lambda x: x[0]):
+        payloads.extend(plan_queries([reporter_id], partner_list, [x[1] for x in group], base))
+    
+    if sink is None:
+        sink = CsvSink('refresh-' + strftime('%Y%m%d') + '.csv')
+    
+    print(str(len(changed)) + ' new or revised reporter-periods, ' + str(len(payloads)) + ' queries.')
+    _run(_fetch_payloads(payloads, sink, refresh = True, parse = False))
+    sink.close()
+    # Only a complete run counts as synced; an interrupted one is repeated.
+    for reporter_id, period in changed:
+        store.mark_synced(reporter_id, period, freq)
+    return()
+
+
+# Deduplication. Outputs of different presets and runs overlap; merge_outputs
+# joins them keeping one version of each record, found through an on-disk
+# hash index rather than by sorting, and reconcile checks partner sums
+# against world totals.
+
+record_key = ['Classification', 'Period', 'Reporter Code', 'Partner Code', 'Trade Flow Code', 'Commodity Code']
+
+class WorldTotals:
+    """
+    Trade value of the World partner (0) and sum over the other partners,
+    per classification, period, reporter, flow and commodity, accumulated
+    chunk by chunk in an SQLite database.
+    """
+    
+    def __init__(self, db = None):
+        self.db = db or sqlite3.connect(':memory:')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS totals (classification TEXT, period TEXT, reporter TEXT, '
+                            'flow TEXT, commodity TEXT, world REAL, partners REAL, partner_count INTEGER, '
+                            'PRIMARY KEY (classification, period, reporter, flow, commodity))')
+    
+    def add(self, df):
+        """Add records read as text (partner and value columns included)."""
+        keys = ['Classification', 'Period', 'Reporter Code', 'Trade Flow Code', 'Commodity Code']
+        value = pd.to_numeric(df['Trade Value (US$)'], errors = 'coerce')
+        world = df['Partner Code'] == '0'
+        grouped = pd.DataFrame({'world': value.where(world), 'partners': value.where(~world),
+                                'partner_count': (~world).astype(int)}).groupby([df[x] for x in keys])
+        sums = grouped[['world', 'partners']].sum(min_count = 1)
+        sums['partner_count'] = grouped['partner_count'].sum()
+        sums = sums.reset_index().astype(object)
+        sums = sums.where(sums.notna(), None)
+        with self.db:
+            self.db.executemany('INSERT INTO totals VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                                'ON CONFLICT (classification, period, reporter, flow, commodity) DO UPDATE SET '
+                                'world = CASE WHEN excluded.world IS NULL THEN world '
+                                'ELSE COALESCE(world, 0) + excluded.world END, '
+                                'partners = CASE WHEN excluded.partners IS NULL THEN partners '
+                                'ELSE COALESCE(partners, 0) + excluded.partners END, '
+                                'partner_count = partner_count + excluded.partner_count',
+                                sums.itertuples(index = False, name = None))
+    
+    def mismatches(self, tolerance = 0.01):
+        """
+        Return the groups where the partner sum is off the world total by
+        more than tolerance (relative). Groups fetched for only a few
+        partners show up as short; partner_count tells them apart.
+        """
+        return pd.read_sql_query('SELECT *, partners - world AS difference FROM totals '
+                                 'WHERE world IS NOT NULL AND partners IS NOT NULL '
+                                 'AND ABS(partners - world) > ? * ABS(world) '
+                                 'ORDER BY classification, period, reporter, flow, commodity',
+                                 self.db, params = [tolerance])
+
+def _read_text(filename, chunk_rows):
+    return pd.read_csv(filename, dtype = str, keep_default_na = False, chunksize = chunk_rows)
+
+def _hash_keys(df):
+    return pd.util.hash_pandas_object(df[record_key], index = False).values.view('int64')
+
+def _record_keys(df):
+    """The record key columns of text records joined into one string per row."""
+    return df[record_key[0]].str.cat([df[x] for x in record_key[1:]], sep = '\x1f')
+
+def merge_outputs(filenames, output, index = None, chunk_rows = bulk_chunk_rows, tolerance = 0.01):
+    """
+    Merge CSV outputs in the API layout (as written by CsvSink) into one
+    file with a single row per (classification, period, reporter, partner,
+    flow, commodity). Files are taken oldest first by modification time
+    and the last version of a record wins, also within a file.
+    Each record key goes into an SQLite index (index, or a temporary file),
+    looked up by its 64-bit hash, in a first pass; the key itself is kept
+    next to the hash so that colliding records stay apart. The second pass
+    writes the winning rows in input order and checks partner sums against
+    world totals.
+    Return a dict of counts and the mismatches found by WorldTotals.
+    """
+    filenames = sorted(filenames, key = os.path.getmtime)
+    temporary = index is None
+    if temporary:
+        fd, index = tempfile.mkstemp(suffix = '.sqlite')
+        os.close(fd)
+    db = sqlite3.connect(index)
+    try:
+        with db:
+            db.execute('DROP TABLE IF EXISTS latest')
+            db.execute('CREATE TABLE latest (hash INTEGER, key TEXT, source INTEGER, row INTEGER, '
+                       'PRIMARY KEY (hash, key)) WITHOUT ROWID')
+        read = 0
+        for source, filename in enumerate(filenames):
+            row = 0
+            for df in _read_text(filename, chunk_rows):
+                with db:
+                    db.executemany('INSERT OR REPLACE INTO latest VALUES (?, ?, ?, ?)',
+                                   zip(_hash_keys(df).tolist(), _record_keys(df).tolist(), itertools.repeat(source),
+                                       range(row, row + len(df))))
+                row += len(df)
+            read += row
+        with db:
+            db.execute('CREATE INDEX latest_source ON latest (source, row)')
+        
+        totals = WorldTotals(db)
+        written = 0
+        with open(output, encoding = 'utf-8', mode = 'w', newline = '') as file:
+            for source, filename in enumerate(filenames):
+                row = 0
+                for df in _read_text(filename, chunk_rows):
+                    winners = [x for x, in db.execute('SELECT row FROM latest WHERE source = ? AND row >= ? '
+                                                      'AND row < ?', (source, row, row + len(df)))]
+                    keep = df.iloc[[x - row for x in sorted(winners)]]
+                    keep.to_csv(file, index = False, header = file.tell() == 0)
+                    totals.add(keep)
+                    written += len(keep)
+                    row += len(df)
+        mismatches = totals.mismatches(tolerance)
+    finally:
+        db.close()
+        if temporary:
+            os.remove(index)
+    print('Merged {} rows from {} files into {}: {} duplicates dropped, {} groups off the world total.'.format(
+        read, len(filenames), output, read - written, len(mismatches)))
+    return {'read': read, 'written': written, 'duplicates': read - written, 'mismatches': mismatches}
+
+def reconcile(filename, tolerance = 0.01, chunk_rows = bulk_chunk_rows):
+    """
+    Check partner sums against world totals in one CSV output. Return
+    the groups off by more than tolerance, as WorldTotals.mismatches.
+    """
+    totals = WorldTotals()
+    for df in _read_text(filename, chunk_rows):
+        totals.add(df)
+    return totals.mismatches(tolerance)
+
+
+# Command line runner. A job is described in a JSON file and checked
+# against the cached reference data before anything is sent:
+#
+#   python comtrade.py job.json --dry-run
+#
+# {"reporters": ["China", "842"],          names or codes, or "all"
+#  "partners": "all",                       names or codes ("World" is 0)
+#  "periods": {"from": "201001", "to": "201604"},   or a list
+#  "freq": "M",
+#  "flows": "imports",                      imports, exports, both or 1, 2
+#  "commodity": "AG6",
+#  "output": {"type": "csv", "path": "china_usa.csv"},
+#                                           csv, parquet, parts or rollup;
+#                                           a list of them writes to each
+#  "checkpoint": true,                      resume csv output after a stop
+#  "prune": true,
+#  "concurrency": 4,
+#  "hourly_budget": 1000,
+#  "tokens": []}                            several tokens make a TokenPool
+
+job_defaults = {'partners': 'all',
+                'freq': 'M',
+                'flows': 'imports',
+                'commodity': 'AG6',
+                'output': {'type': 'csv', 'path': 'job.csv'},
+                'checkpoint': True,
+                'prune': True,
+                'concurrency': concurrency,
+                'hourly_budget': 1000,
+                'burst': 5,
+                'tokens': [],
+                'auth_code': None,
+                # Typical seconds per request, for the wall time estimate.
+                'request_seconds': 3.0
+}
+job_flows = {'imports': '1', 'exports': '2', 'both': 'all', '1': '1', '2': '2', 'all': 'all'}
+
+def _valid_period(period, freq):
+    """Whether period is a YYYY (freq A) or YYYYMM (freq M) period."""
+    length = 4 if freq == 'A' else 6
+    return period.isdigit() and len(period) == length and (freq == 'A' or 1 <= int(period[4:]) <= 12)
+
+def _period_range(periods, freq):
+    """Expand a period list or {"from", "to"} range; return (periods, errors)."""
+    if not isinstance(periods, (dict, list, str, int)):
+        return [], ['periods must be a list, a period or a {"from", "to"} range, not ' + repr(periods) + '.']
+    if isinstance(periods, dict):
+        start, end = str(periods.get('from', '')), str(periods.get('to', ''))
+        # Check the ends before expanding, or month 13 would wrap into the next year.
+        invalid = [x for x in (start, end) if not _valid_period(x, freq)]
+        if invalid:
+            return [], ['Invalid period ' + repr(x) + ' for freq ' + str(freq) + '.' for x in invalid]
+        if freq == 'A':
+            periods = [str(x) for x in range(int(start), int(end) + 1)]
+        else:
+            months = range(int(start[:4]) * 12 + int(start[4:]) - 1, int(end[:4]) * 12 + int(end[4:]))
+            periods = [str(x // 12) + str(x % 12 + 1).zfill(2) for x in months]
+        if not periods:
+            return [], ['Period range from ' + start + ' to ' + end + ' is empty.']
+    periods = [str(x) for x in ([periods] if isinstance(periods, (str, int)) else periods)]
+    errors = ['Invalid period ' + repr(x) + ' for freq ' + str(freq) + '.' for x in periods
+              if not _valid_period(x, freq)]
+    if not periods:
+        errors.append('No periods given.')
+    return periods, errors
+
+def _area_codes(kind, values):
+    """Resolve area names or codes against the cached reference data; return (codes, errors)."""
+    if not isinstance(values, (list, str, int)):
+        return [], [kind.capitalize() + 's must be a list, a name or a code, not ' + repr(values) + '.']
+    reference = _reference_data(kind, offline = True)
+    if values == 'all' or values == ['all']:
+        return list(reference['list']), []
+    codes, errors = [], []
+    for value in ([values] if isinstance(values, (str, int)) else values):
+        value = str(value)
+        if value in reference['dict']:
+            codes.append(value)
+        elif value in reference['reverse']:
+            codes.append(reference['reverse'][value])
+        else:
+            errors.append('Unknown ' + kind + ' ' + repr(value) + '.')
+    return codes, errors
+
+def load_job(spec):
+    """
+    Check a job spec (dict) against the cached reference data, without
+    using the network. Return (job, errors): the spec with defaults filled
+    in and areas, periods and flows resolved to codes, and a list of
+    problems found.
+    """
+    if not isinstance(spec, dict):
+        return dict(job_defaults), ['A job spec must be a JSON object, not ' + repr(spec) + '.']
+    job = dict(job_defaults, **spec)
+    errors = ['Unknown job setting ' + repr(x) + '.' for x in spec
+              if x not in job_defaults and x not in ('reporters', 'periods')]
+    if 'reporters' not in spec:
+        errors.append('No reporters given.')
+    if job['freq'] not in ('A', 'M'):
+        errors.append('freq must be A or M.')
+    if str(job['flows']) not in job_flows:
+        errors.append('Unknown flows ' + repr(job['flows']) + '.')
+    try:
+        job['reporters'], found = _area_codes('reporter', spec.get('reporters', []))
+        errors.extend(found)
+        job['partners'], found = _area_codes('partner', job['partners'])
+        errors.extend(found)
+    except FileNotFoundError as e:
+        errors.append(str(e))
+    job['periods'], found = _period_range(spec.get('periods', []), job['freq'])
+    errors.extend(found)
+    job['flows'] = job_flows.get(str(job['flows']))
+    outputs = job['output'] if isinstance(job['output'], list) else [job['output']]
+    for output in outputs:
+        if not isinstance(output, dict):
+            errors.append('Output must be an object with a type, not ' + repr(output) + '.')
+        elif output.get('type') not in ('csv', 'parquet', 'parts', 'rollup'):
+            errors.append('Unknown output type ' + repr(output.get('type')) + '.')
+        elif output['type'] != 'rollup' and not (isinstance(output.get('path'), str) and output['path']):
+            errors.append('Output ' + output['type'] + ' needs a path.')
+        elif output['type'] == 'parquet' and pyarrow is None:
+            errors.append('Parquet output requires pyarrow.')
+        elif output['type'] == 'rollup' and str(job['commodity']).upper() not in ('AG6', 'ALL'):
+            errors.append('Output rollup needs commodity AG6 or ALL.')
+    job['output'] = outputs
+    if job['checkpoint'] and sum(isinstance(x, dict) and x.get('type') == 'csv' for x in outputs) > 1:
+        errors.append('A checkpoint resumes a single csv output; set checkpoint to false for several.')
+    if not isinstance(job['concurrency'], int) or job['concurrency'] < 1:
+        errors.append('concurrency must be a positive integer.')
+    for key in ['hourly_budget', 'burst', 'request_seconds']:
+        if not isinstance(job[key], (int, float)) or job[key] <= 0:
+            errors.append(key + ' must be a positive number.')
+    if not isinstance(job['tokens'], list) or not all(isinstance(x, str) and x for x in job['tokens']):
+        errors.append('tokens must be a list of token strings.')
+    if job['auth_code'] is not None and not isinstance(job['auth_code'], str):
+        errors.append('auth_code must be a string.')
+    if not isinstance(job['commodity'], str) or not job['commodity']:
+        errors.append('commodity must be a string such as "AG6" or "01,02", not ' + repr(job['commodity']) + '.')
+    return job, errors
+
+def plan_job(job, offline = False):
+    """Return the query payloads of a loaded job."""
+    base = {'type': 'C',
+            'freq': job['freq'],
+            'px': 'HS',
+            'rg': job['flows'],
+            'cc': job['commodity'],
+            'fmt': 'csv'
+    }
+    return _plan(job['reporters'], job['partners'], job['periods'], base, job['prune'], offline)
+
+def estimate_wall_time(requests, job):
+    """
+    Seconds a job of the given number of requests should take: the longer
+    of the time the hourly quota allows them in and the time to send them
+    at the job's concurrency.
+    """
+    tokens = max(len(job['tokens']), 1)
+    quota = max(0, requests - job['burst'] * tokens) / (job['hourly_budget'] * tokens / 3600)
+    return max(quota, requests * job['request_seconds'] / job['concurrency'])
+
+def _job_sink(job, checkpoint):
+    """
+    Return the sink writing to the job's outputs. The csv output the
+    checkpoint belongs to resumes from its offset, and its size is what
+    the checkpoint records.
+    """
+    sinks = []
+    synced = None
+    for output in job['output']:
+        if output['type'] == 'csv' and synced is None:
+            synced = CsvSink(output['path'], offset = checkpoint.offset() if checkpoint is not None else None)
+            sinks.append(synced)
+        elif output['type'] == 'csv':
+            sinks.append(CsvSink(output['path']))
+        elif output['type'] == 'parquet':
+            sinks.append(ParquetSink(output['path']))
+        elif output['type'] == 'parts':
+            sinks.append(CsvPartSink(output['path']))
+        else:
+            sinks.append(RollupSink(output.get('path')))
+    return sinks[0] if len(sinks) == 1 else TeeSink(*sinks, synced = synced)
+
+def apply_job(job):
+    """
+    Apply the job's concurrency, token and quota settings to the module,
+    before anything is sent for it, availability requests included.
+    """
+    global concurrency, rate_limiter, token_pool, auth_code
+    concurrency = job['concurrency']
+    if len(job['tokens']) > 1:
+        token_pool = TokenPool(job['tokens'], job['hourly_budget'], job['burst'])
+    else:
+        rate_limiter = RateLimiter(job['hourly_budget'], job['burst'])
+        auth_code = (job['tokens'] or [job['auth_code'] or auth_code])[0]
+
+def run_job(job, payloads):
+    """Fetch the payloads of a job whose settings apply_job applied."""
+    checkpoint = None
+    csv_outputs = [x for x in job['output'] if x['type'] == 'csv']
+    if job['checkpoint'] and csv_outputs:
+        checkpoint = Checkpoint(csv_outputs[0]['path'] + '.checkpoint')
+    sink = _job_sink(job, checkpoint)
+    _run(_fetch_payloads(payloads, sink, checkpoint, parse = False))
+    sink.close()
+    if checkpoint is not None:
+        checkpoint.close()
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Run a UN Comtrade download job described in a JSON file.')
+    parser.add_argument('job', help = 'JSON job spec')
+    parser.add_argument('--dry-run', action = 'store_true',
+                        help = 'check and plan the job offline and report the requests it needs')
+    args = parser.parse_args(argv)
+    with open(args.job, encoding = 'utf-8') as file:
+        spec = json.load(file)
+    
+    job, errors = load_job(spec)
+    if not args.dry_run and any(x.startswith('No cached reference data') for x in errors):
+        # First run on this machine: fetch the reference files once.
+        get_reporters(), get_partners()
+        job, errors = load_job(spec)
+    if errors:
+        for error in errors:
+            print(error)
+        return 2
+    
+    if not args.dry_run:
+        apply_job(job)
+    payloads = plan_job(job, offline = args.dry_run)
+    seconds = estimate_wall_time(len(payloads), job)
+    print('{} reporters, {} partners, {} periods: {} requests, about {} at {} requests per hour{}.'.format(
+        len(job['reporters']), len(job['partners']), len(job['periods']), len(payloads),
+        datetime.timedelta(seconds = round(seconds)), job['hourly_budget'] * max(len(job['tokens']), 1),
+        ' over ' + str(len(job['tokens'])) + ' tokens' if len(job['tokens']) > 1 else ''))
+    if args.dry_run:
+        return 0
+    run_job(job, payloads)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,265 @@
+"""
+Local stand-in for the UN Comtrade API, for working on the fetchers
+without network access or quota.
+
+It answers /api/get, /api/get/bulk, /api/refs/da/bulk and the reporter and
+partner reference files with generated, deterministic data, and can be
+made to behave like the real service: latency, rate limit replies (the
+legacy 409 RATE LIMIT text or HTTP 429 with Retry-After), error bodies,
+empty results and truncation at the requested max rows.
+
+Usage:
+python mock_server.py --port 8000 --latency 1.5 --rate-limit 1
+
+Then point the module at it:
+comtrade.base_url = 'http://localhost:8000'
+"""
+
+import argparse
+import collections
+import gzip
+import hashlib
+import io
+import json
+import random
+import threading
+import urllib.parse
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, monotonic
+
+header = ['Classification', 'Year', 'Period', 'Period Desc.', 'Aggregate Level', 'Is Leaf Code',
+          'Trade Flow Code', 'Trade Flow', 'Reporter Code', 'Reporter', 'Reporter ISO', 'Partner Code',
+          'Partner', 'Partner ISO', '2nd Partner Code', '2nd Partner', '2nd Partner ISO',
+          'Customs Proc. Code', 'Customs', 'Mode of Transport Code', 'Mode of Transport',
+          'Commodity Code', 'Commodity', 'Qty Unit Code', 'Qty Unit', 'Qty', 'Alt Qty Unit Code',
+          'Alt Qty Unit', 'Alt Qty', 'Netweight (kg)', 'Gross weight (kg)', 'Trade Value (US$)',
+          'CIF Trade Value (US$)', 'FOB Trade Value (US$)', 'Flag']
+no_data = ('No data matches your query or your query is too complex. '
+           'Request JSON or XML format for more information.' + ',' * (len(header) - 1))
+server_error = '{"Message":"An error has occurred."}'
+
+class MockComtrade:
+    """
+    Generated Comtrade data and the service behaviour to serve it with.
+
+    reporters, partners: number of reporter and partner areas (partner 0,
+    World, and 490, Other Asia nes, are always added)
+    rows_per_cell: commodity rows per reporter, partner, period and flow
+    empty_ratio: share of reporter-partner-period cells without data
+    latency: seconds spent on every API answer
+    error_rate: share of queries answered with a server error
+    rate_limit: requests per second allowed per token, None for no limit
+    hourly_quota: requests per hour allowed per token, None for no limit
+    tokens: accepted tokens, None to accept any
+    rate_limit_status: 409 to answer over the limit with the RATE LIMIT
+    text, 429 to answer with HTTP 429 and a Retry-After header
+    """
+
+    def __init__(self, reporters = 20, partners = 30, rows_per_cell = 50, empty_ratio = 0.3,
+                 latency = 0.0, error_rate = 0.0, rate_limit = None, hourly_quota = None,
+                 tokens = None, seed = 0, rate_limit_status = 409):
+        self.reporters = [str(x) for x in range(4, 4 + 4 * reporters, 4)]
+        self.partners = ['0'] + [str(x) for x in range(4, 4 + 4 * partners, 4)] + ['490']
+        self.commodities = ['{:02d}{:02d}{:02d}'.format(1 + i % 97, 1 + i // 97 % 99, 10 + i % 89)
+                            for i in range(rows_per_cell)]
+        self.rows_per_cell = rows_per_cell
+        self.empty_ratio = empty_ratio
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.hourly_quota = hourly_quota
+        self.rate_limit_status = rate_limit_status
+        self.tokens = tokens
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.history = collections.defaultdict(collections.deque)
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+
+    def count(self, key, n = 1):
+        with self.lock:
+            self.stats[key] += n
+
+    def has_data(self, r, p, ps):
+        digest = hashlib.sha1('{}|{}|{}|{}'.format(self.seed, r, p, ps).encode('utf-8')).digest()
+        return digest[0] / 256 >= self.empty_ratio
+
+    def rows(self, reporters, partners, periods, flows):
+        for ps in periods:
+            for r in reporters:
+                for p in partners:
+                    if not self.has_data(r, p, ps):
+                        continue
+                    for flow in flows:
+                        for i, code in enumerate(self.commodities):
+                            value = (int(r) * 7919 + int(p) * 104729 + int(ps) + i * 31 + int(flow)) % 1000000
+                            yield ['H4', ps[:4], ps, ps, '6', '1', flow, 'Import' if flow == '1' else 'Export',
+                                   r, 'Country ' + r, 'C' + r, p, 'World' if p == '0' else 'Country ' + p,
+                                   'C' + p, '', '', '', '', '', '', '', code, 'Commodity ' + code, '8',
+                                   'Weight in kilograms', str(value // 10), '', '', '', str(value // 10),
+                                   '', str(value), '', '', '0']
+
+    @staticmethod
+    def _csv(rows):
+        lines = [','.join(header)]
+        lines.extend(','.join(row) for row in rows)
+        return '\r\n'.join(lines) + '\r\n'
+
+    def throttle(self, token):
+        """Return None, or the number of seconds the client must wait."""
+        if self.rate_limit is None and self.hourly_quota is None:
+            return None
+        with self.lock:
+            now = monotonic()
+            history = self.history[token]
+            while history and now - history[0] > 3600:
+                history.popleft()
+            if self.rate_limit is not None and history and now - history[-1] < 1 / self.rate_limit:
+                return 1
+            if self.hourly_quota is not None and len(history) >= self.hourly_quota:
+                return int(3600 - (now - history[0])) + 1
+            history.append(now)
+            return None
+
+    def get(self, query):
+        """Answer /api/get. Return (status, body) or (status, body, headers)."""
+        sleep(self.latency)
+        self.count('api')
+        token = query.get('token', '')
+        if self.tokens is not None and token not in self.tokens:
+            self.count('rejected')
+            return 401, 'Invalid token.'
+        wait = self.throttle(token)
+        if wait is not None:
+            self.count('rate_limited')
+            if self.rate_limit_status == 429:
+                return 429, 'Too many requests.', {'Retry-After': str(wait)}
+            return 409, 'RATE LIMIT: You must wait {} seconds.'.format(wait)
+        with self.lock:
+            failed = self.random.random() < self.error_rate
+        if failed:
+            self.count('errors')
+            return 500, server_error
+
+        def codes(key, default):
+            value = query.get(key, 'all')
+            return default if value == 'all' else value.split(',')
+        flows = ['1', '2'] if query.get('rg', 'all') == 'all' else query['rg'].split(',')
+        rows = []
+        limit = int(query.get('max', 500))
+        for row in self.rows(codes('r', self.reporters), codes('p', self.partners), codes('ps', []), flows):
+            rows.append(row)
+            if len(rows) == limit:
+                self.count('truncated')
+                break
+        self.count('rows', len(rows))
+        if not rows:
+            self.count('empty')
+            return 200, ','.join(header) + '\r\n' + no_data + '\r\n'
+        return 200, self._csv(rows)
+
+    def availability(self, query):
+        """Answer /api/refs/da/bulk."""
+        records = []
+        for ps in query.get('ps', '').split(','):
+            for r in self.reporters:
+                cells = sum(self.has_data(r, p, ps) for p in self.partners)
+                if cells:
+                    records.append({'type': 'COMMODITIES', 'freq': query.get('freq', 'A'), 'px': 'HS', 'r': r,
+                                    'rDesc': 'Country ' + r, 'ps': ps,
+                                    'TotalRecords': cells * 2 * self.rows_per_cell, 'isOriginal': 1,
+                                    'publicationDate': '2017-01-01T00:00:00', 'isPartnerDetail': 1})
+        return 200, json.dumps(records)
+
+    def bulk(self, year):
+        """Answer /api/get/bulk with a zipped CSV for the year."""
+        out = io.BytesIO()
+        with zipfile.ZipFile(out, mode = 'w', compression = zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('type-C_r-ALL_ps-{}_freq-A_px-HS.csv'.format(year),
+                             self._csv(self.rows(self.reporters, self.partners, [str(year)], ['1', '2'])))
+        return 200, out.getvalue()
+
+    def reference(self, kind):
+        ids = self.reporters if kind == 'reporter' else self.partners
+        results = [{'id': 'all', 'text': 'All'}]
+        results.extend({'id': x, 'text': 'World' if x == '0' else 'Country ' + x} for x in ids)
+        return 200, json.dumps({'more': False, 'results': results})
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        mock = self.server.mock
+        parsed = urllib.parse.urlparse(self.path)
+        path = '/' + '/'.join(x for x in parsed.path.split('/') if x)
+        query = {k: v[-1] for k, v in urllib.parse.parse_qs(parsed.query).items()}
+        mock.count('requests')
+
+        headers = {}
+        if path == '/api/get':
+            status, body, *extra = mock.get(query)
+            if extra:
+                headers = extra[0]
+        elif path.startswith('/api/get/bulk/'):
+            status, body = mock.bulk(path.split('/')[6])
+        elif path == '/api/refs/da/bulk':
+            status, body = mock.availability(query)
+        elif path == '/data/cache/reporterAreas.json':
+            status, body = mock.reference('reporter')
+        elif path == '/data/cache/partnerAreas.json':
+            status, body = mock.reference('partner')
+        else:
+            status, body = 404, 'Not found.'
+
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        if 'gzip' in self.headers.get('Accept-Encoding', '') and len(body) > 1024:
+            body = gzip.compress(body, compresslevel = 1)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        mock.count('bytes', len(body))
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(mock = None, host = '127.0.0.1', port = 0):
+    """
+    Start a server for mock (a default MockComtrade if None) in a
+    background thread. Return the server; its base URL is server.url and
+    server.shutdown() stops it.
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.mock = mock or MockComtrade()
+    server.url = 'http://{}:{}'.format(*server.server_address)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Local stand-in for the UN Comtrade API.')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8000)
+    parser.add_argument('--reporters', type = int, default = 20)
+    parser.add_argument('--partners', type = int, default = 30)
+    parser.add_argument('--rows-per-cell', type = int, default = 50)
+    parser.add_argument('--empty-ratio', type = float, default = 0.3)
+    parser.add_argument('--latency', type = float, default = 0.0)
+    parser.add_argument('--error-rate', type = float, default = 0.0)
+    parser.add_argument('--rate-limit', type = float, default = None)
+    parser.add_argument('--hourly-quota', type = int, default = None)
+    parser.add_argument('--rate-limit-status', type = int, choices = [409, 429], default = 409)
+    args = parser.parse_args()
+    mock = MockComtrade(args.reporters, args.partners, args.rows_per_cell, args.empty_ratio, args.latency,
+                        args.error_rate, args.rate_limit, args.hourly_quota,
+                        rate_limit_status = args.rate_limit_status)
+    server = serve(mock, args.host, args.port)
+    print('Serving the mock Comtrade API on ' + server.url + '.')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,216 @@
+"""
+End-to-end tests of the fetchers against the local mock server
+(mock_server.py): checkpoint resume, truncation splits, retries,
+pruning, work queue failures and merge_outputs.
+
+Run with python -m pytest from this directory or the repository root.
+"""
+
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pytest
+
+import comtrade
+import mock_server
+
+base = {'type': 'C',
+        'freq': 'M',
+        'px': 'HS',
+        'rg': '1',
+        'cc': 'AG6',
+        'fmt': 'csv'
+}
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    """
+    Point comtrade at a fresh cache in tmp_path, with quota and retry
+    delays lifted, and return start(**options), which serves a
+    MockComtrade built with options and points base_url at it.
+    """
+    monkeypatch.chdir(tmp_path)
+    settings = {'cache_dir': str(tmp_path / 'cache'),
+                'bulk_dest': str(tmp_path / 'bulk') + os.sep,
+                'rate_limiter': comtrade.RateLimiter(hourly_budget = 10 ** 9, burst = 8),
+                'token_pool': None,
+                'auth_code': '',
+                'concurrency': 4,
+                'show_progress': False,
+                'retry_policies': {comtrade.RateLimitError: comtrade.Backoff(0, 0),
+                                   comtrade.ServerError: comtrade.Backoff(0, 0, attempts = 20),
+                                   comtrade.TransportError: comtrade.Backoff(0, 0, attempts = 2)},
+                '_reference': {},
+                '_availability_store': None,
+                '_trade_store': None,
+                '_row_estimates': None,
+                '_response_cache': None
+    }
+    for name, value in settings.items():
+        monkeypatch.setattr(comtrade, name, value)
+    comtrade.metrics.reset()
+    servers = []
+
+    def start(**options):
+        mock = mock_server.MockComtrade(**dict({'reporters': 3, 'partners': 4}, **options))
+        server = mock_server.serve(mock)
+        servers.append(server)
+        monkeypatch.setattr(comtrade, 'base_url', server.url)
+        return mock
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+def _rows(responses):
+    return sum(comtrade._row_count(resp.text) for _, resp in responses if not comtrade._no_data(resp.text))
+
+def test_resume_keeps_the_csv_output_of_a_teed_job(api):
+    api(reporters = 8)
+    comtrade.get_reporters(), comtrade.get_partners()
+    spec = {'reporters': 'all',
+            'periods': {'from': '201501', 'to': '201612'},
+            'prune': False,
+            'hourly_budget': 10 ** 9,
+            'burst': 8,
+            'output': [{'type': 'rollup'}, {'type': 'csv', 'path': 'out.csv'}]}
+    job, errors = comtrade.load_job(spec)
+    assert errors == []
+    comtrade.apply_job(job)
+    comtrade.run_job(job, comtrade.plan_job(job))
+    with open('out.csv', mode = 'rb') as file:
+        expected = file.read()
+
+    # Stopped after the last unit was written but before it was recorded.
+    db = sqlite3.connect('out.csv.checkpoint')
+    with db:
+        assert db.execute('SELECT COUNT(*) FROM units').fetchone()[0] > 1
+        db.execute("UPDATE units SET status = 'pending', offset = NULL "
+                   "WHERE offset = (SELECT MAX(offset) FROM units)")
+    db.close()
+    comtrade.run_job(job, comtrade.plan_job(job))
+    with open('out.csv', mode = 'rb') as file:
+        assert file.read() == expected
+
+def test_truncated_results_are_split(api):
+    mock = api()
+    payload = dict(base, r = ','.join(mock.reporters), p = ','.join(mock.partners), ps = '201601', max = 100)
+    rows = _rows(comtrade.fetch_batch([payload]))
+    assert mock.stats['truncated'] > 0
+    assert comtrade.metrics.counters['splits'] > 0
+    assert rows == len(list(mock.rows(mock.reporters, mock.partners, ['201601'], ['1'])))
+
+@pytest.mark.parametrize('status', [409, 429])
+def test_rate_limit_replies_are_retried(api, status):
+    mock = api(rate_limit = 20, rate_limit_status = status)
+    payloads = [dict(base, r = x, p = 'all', ps = '201601') for x in mock.reporters]
+    responses = list(comtrade.fetch_batch(payloads))
+    assert len(responses) == len(payloads)
+    assert mock.stats['rate_limited'] > 0
+    assert comtrade.metrics.counters['retries.RateLimitError'] > 0
+    assert _rows(responses) == len(list(mock.rows(mock.reporters, mock.partners, ['201601'], ['1'])))
+
+def test_retry_after_header_sets_the_wait():
+    resp = type('Response', (), {'text': 'Too many requests.', 'status_code': 429, 'headers': {'Retry-After': '7'}})
+    error = comtrade.classify(resp)
+    assert isinstance(error, comtrade.RateLimitError) and error.wait == 7
+
+def test_server_errors_are_retried(api):
+    mock = api(error_rate = 0.5)
+    payloads = [dict(base, r = x, p = 'all', ps = '201601') for x in mock.reporters]
+    responses = list(comtrade.fetch_batch(payloads))
+    assert mock.stats['errors'] > 0
+    assert all(comtrade.classify(resp) is None for _, resp in responses if not comtrade._no_data(resp.text))
+    assert _rows(responses) == len(list(mock.rows(mock.reporters, mock.partners, ['201601'], ['1'])))
+
+def test_client_errors_are_neither_retried_nor_cached(api):
+    mock = api()
+    calls = []
+    def get(query):
+        calls.append(query)
+        return 400, 'Bad query.'
+    mock.get = get
+    payload = dict(base, r = mock.reporters[0], p = 'all', ps = '201601')
+    with pytest.raises(comtrade.ClientError):
+        comtrade._request(payload)
+    assert len(calls) == 1
+    assert comtrade.response_cache().get(payload) is None
+
+def _availability(mock, change):
+    answer = mock.availability
+    def availability(query):
+        status, body = answer(query)
+        return status, json.dumps(change(json.loads(body)))
+    mock.availability = availability
+
+def test_pruning_drops_reporters_without_data(api):
+    mock = api()
+    _availability(mock, lambda records: [x for x in records if x['r'] != mock.reporters[1]])
+    payloads = comtrade._plan(mock.reporters[:2], mock.partners[1:3], ['201501'], base)
+    assert [x['r'] for x in payloads] == [mock.reporters[0]]
+
+def test_pruning_ignores_availability_labels(api):
+    mock = api()
+    def relabel(records):
+        for x in records:
+            x['freq'], x['px'] = 'MONTHLY', 'H4'
+        return records
+    _availability(mock, relabel)
+    payloads = comtrade._plan(mock.reporters[:2], mock.partners[1:3], ['201501', '201502'], base)
+    assert payloads and {x['r'] for x in payloads} == {','.join(mock.reporters[:2])}
+    assert comtrade.availability_store().changed(['201501'], 'M')
+
+def test_periods_without_availability_records_are_not_pruned(api):
+    mock = api()
+    _availability(mock, lambda records: [])
+    payloads = comtrade._plan(mock.reporters[:2], mock.partners[1:3], ['201501'], base)
+    assert [x['r'] for x in payloads] == [','.join(mock.reporters[:2])]
+
+def test_work_queue_fails_bad_units_and_goes_on(api, tmp_path):
+    mock = api()
+    answer = mock.get
+    bad = {(mock.reporters[0], '201601'): (400, 'Bad query.'),
+           (mock.reporters[1], '201601'): (500, mock_server.server_error)}
+    mock.get = lambda query: bad.get((query.get('r'), query.get('ps'))) or answer(query)
+    comtrade.retry_policies[comtrade.ServerError] = comtrade.Backoff(0, 0, attempts = 1)
+    filename = str(tmp_path / 'queue.sqlite')
+    queue = comtrade.WorkQueue(filename)
+    queue.add([dict(base, r = r, p = 'all', ps = ps) for r in mock.reporters for ps in ['201601', '201602']])
+    queue.close()
+    comtrade.run_worker(filename, str(tmp_path / 'parts'))
+    queue = comtrade.WorkQueue(filename)
+    assert queue.counts() == {'done': 4, 'failed': 2}
+    errors = {payload['r']: error for payload, error in queue.failed()}
+    assert errors[mock.reporters[0]].startswith('ClientError')
+    assert errors[mock.reporters[1]].startswith('ServerError')
+    queue.close()
+
+def _write_csv(filename, rows):
+    with open(filename, encoding = 'utf-8', mode = 'w', newline = '') as file:
+        file.write(mock_server.MockComtrade._csv(rows))
+
+def test_merge_outputs_keeps_the_latest_version(tmp_path, monkeypatch):
+    mock = mock_server.MockComtrade(3, 4)
+    rows = list(mock.rows(mock.reporters, mock.partners, ['201601'], ['1']))
+    index = mock_server.header.index('Trade Value (US$)')
+    revised = [row[:index] + ['1'] + row[index + 1:] for row in rows[:10]]
+    _write_csv(tmp_path / 'old.csv', rows)
+    _write_csv(tmp_path / 'new.csv', revised)
+    os.utime(tmp_path / 'old.csv', (time.time() - 60, time.time() - 60))
+    filenames = [str(tmp_path / 'new.csv'), str(tmp_path / 'old.csv')]
+
+    result = comtrade.merge_outputs(filenames, str(tmp_path / 'merged.csv'))
+    assert (result['read'], result['written'], result['duplicates']) == (len(rows) + 10, len(rows), 10)
+    with open(tmp_path / 'merged.csv', encoding = 'utf-8') as file:
+        merged = file.read()
+    assert merged.count(',1,,,0\n') == 10
+
+    # Records whose keys hash alike must still be told apart.
+    monkeypatch.setattr(comtrade, '_hash_keys', lambda df: np.zeros(len(df), dtype = 'int64'))
+    result = comtrade.merge_outputs(filenames, str(tmp_path / 'collided.csv'))
+    assert result['written'] == len(rows)
+    with open(tmp_path / 'collided.csv', encoding = 'utf-8') as file:
+        assert file.read() == merged